@@ -0,0 +1,111 @@
+"""
+Measure how the time to ask for a new trial grows with the size of the study.
+
+Usage:
+
+    python benchmarks/ask_latency.py --trials 100 500 1000 2000
+
+A study in a temporary SQLite DB is filled with completed trials, and at each size
+the time to read the trial history and the time for `study.ask()` (including the
+sampler's suggestions) are measured, with optuna's default cached RDB storage and
+with `TrialHistoryCache`.
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+import optuna
+from optuna.distributions import (IntUniformDistribution,
+                                  LogUniformDistribution, UniformDistribution)
+from optuna.samplers import CmaEsSampler, TPESampler
+from optuna.storages import RDBStorage
+
+from ampopt.study import TrialHistoryCache
+
+distributions = {
+    "num_layers": IntUniformDistribution(6, 20),
+    "num_nodes": IntUniformDistribution(10, 30),
+    "dropout_rate": UniformDistribution(0.0, 0.2),
+    "lr": LogUniformDistribution(1e-5, 1e-1),
+}
+
+
+def random_trial():
+    params = {
+        "num_layers": random.randint(6, 20),
+        "num_nodes": random.randint(10, 30),
+        "dropout_rate": random.uniform(0.0, 0.2),
+        "lr": 10 ** random.uniform(-5, -1),
+    }
+    return optuna.trial.create_trial(
+        params=params, distributions=distributions, value=random.random()
+    )
+
+
+def time_asks(study, repeats):
+    """Return the mean time to read the trial history and to ask for a trial."""
+    # Load the trials added since the last call, which only happens once in a study
+    study.tell(study.ask(distributions), random.random())
+    time.sleep(1.0)
+
+    read, ask = 0.0, 0.0
+    for _ in range(repeats):
+        start = time.perf_counter()
+        study.get_trials(deepcopy=False)
+        read += time.perf_counter() - start
+
+        start = time.perf_counter()
+        trial = study.ask(distributions)
+        ask += time.perf_counter() - start
+        study.tell(trial, random.random())
+    return read / repeats, ask / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--trials", type=int, nargs="+", default=[100, 500, 1000])
+    parser.add_argument("--repeats", type=int, default=20)
+    parser.add_argument("--sampler", choices=["TPE", "CmaEs"], default="TPE")
+    args = parser.parse_args()
+
+    optuna.logging.set_verbosity(optuna.logging.WARNING)
+    samplers = {"TPE": TPESampler, "CmaEs": CmaEsSampler}
+
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{Path(tmp) / 'benchmark.db'}"
+        study = optuna.create_study(study_name="benchmark", storage=url)
+        studies = {
+            "default": optuna.load_study(
+                study_name="benchmark",
+                storage=url,
+                sampler=samplers[args.sampler](seed=0),
+            ),
+            "cached": optuna.load_study(
+                study_name="benchmark",
+                storage=TrialHistoryCache(RDBStorage(url)),
+                sampler=samplers[args.sampler](seed=0),
+            ),
+        }
+
+        print(f"Sampler: {args.sampler}, mean over {args.repeats} asks (ms)\n")
+        print(
+            f"{'trials':>7} {'read':>9} {'ask':>9} {'read (cached)':>14} "
+            f"{'ask (cached)':>13}"
+        )
+        for n_trials in sorted(args.trials):
+            while len(study.get_trials(deepcopy=False)) < n_trials:
+                study.add_trial(random_trial())
+
+            results = [time_asks(studies[name], args.repeats) for name in studies]
+            (read, ask), (cached_read, cached_ask) = results
+            print(
+                f"{n_trials:>7} {read * 1e3:>9.2f} {ask * 1e3:>9.2f} "
+                f"{cached_read * 1e3:>14.2f} {cached_ask * 1e3:>13.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
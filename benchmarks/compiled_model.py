@@ -0,0 +1,93 @@
+"""
+Compare the training and prediction speed of eager and TorchScript-compiled models.
+
+Usage:
+
+    python benchmarks/compiled_model.py data/oc20_3k_train.lmdb --num-layers 10 \
+        --num-nodes 20
+
+A model of the given architecture is trained on the LMDB for a few epochs, once as
+plain PyTorch and once with its MLPs compiled (as `tune --torchscript` does), and
+the median time per epoch and the inference latency of each are reported.
+"""
+
+import argparse
+import statistics
+import time
+from uuid import uuid4
+
+import torch
+from amptorch.trainer import AtomsTrainer
+
+from ampopt.predict import measure_latency
+from ampopt.preprocess import read_lmdb_metadata, read_lmdb_records
+from ampopt.scripting import script_mlps
+from ampopt.train import default_params, mk_config
+
+
+def run(lmdb, hparams, epochs, precision, torchscript):
+    config = mk_config(
+        hparams,
+        lmdb,
+        epochs=epochs,
+        identifier=f"benchmark-{uuid4()}",
+        precision=precision,
+        verbose=False,
+    )
+    config["cmd"]["debug"] = True  # don't write checkpoints
+    trainer = AtomsTrainer(config)
+
+    start = time.perf_counter()
+    if torchscript:
+        script_mlps(trainer.net.module)
+    compile_time = time.perf_counter() - start
+
+    trainer.train()
+    # Skip the first epoch, which includes warm-up (and TorchScript's optimization)
+    epoch_time = statistics.median(trainer.net.history[1:, "dur"])
+    latency = measure_latency(trainer, read_lmdb_records(lmdb, 100))
+    return compile_time, epoch_time, latency
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("lmdb", help="preprocessed LMDB to train on")
+    parser.add_argument("--num-layers", type=int, default=10)
+    parser.add_argument("--num-nodes", type=int, default=20)
+    parser.add_argument("--epochs", type=int, default=10)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+
+    precision = read_lmdb_metadata(args.lmdb, "precision", default="float64")
+    hparams = {
+        **default_params,
+        "num_layers": args.num_layers,
+        "num_nodes": args.num_nodes,
+        "dropout_rate": 0.0,
+        "lr": 1e-3,
+        "gamma": 1.0,
+    }
+
+    print(
+        f"{args.num_layers}x{args.num_nodes} model, {args.epochs} epochs on "
+        f"{args.lmdb} ({precision}, {torch.get_num_threads()} threads)\n"
+    )
+    results = {
+        name: run(args.lmdb, hparams, args.epochs, precision, torchscript)
+        for name, torchscript in [("eager", False), ("torchscript", True)]
+    }
+
+    print(f"{'':>12} {'compile (s)':>12} {'epoch (s)':>10} {'latency/atom (s)':>17}")
+    for name, (compile_time, epoch_time, latency) in results.items():
+        print(f"{name:>12} {compile_time:>12.3f} {epoch_time:>10.3f} {latency:>17.3g}")
+
+    eager, scripted = results["eager"], results["torchscript"]
+    print(f"\nSpeedup per epoch: {eager[1] / scripted[1]:.2f}x")
+    print(f"Speedup of inference: {eager[2] / scripted[2]:.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Compare the size and load time of an LMDB stored with each compression codec.
+
+Usage:
+
+    python benchmarks/lmdb_compression.py data/oc20_3k_train.lmdb \
+        --output-dir ~/scratch
+
+The images in the given LMDB are rewritten uncompressed and with every available
+codec (to a temporary directory in `--output-dir`, which should be on the
+filesystem training reads from), and each copy is read in full, as a training run
+with a full cache would. The copy is evicted from the page cache before each read,
+so that reads come from disk.
+"""
+
+import argparse
+import os
+import pickle
+import tempfile
+import time
+from pathlib import Path
+
+import lmdb
+
+from ampopt.compression import CompressedRecord, available_codecs
+from ampopt.preprocess import read_lmdb_metadata, read_lmdb_records
+
+
+def write(path: Path, records, codec: str = None) -> None:
+    db = lmdb.open(
+        str(path), map_size=64_393_216 * 2 * 12, subdir=False, meminit=False
+    )
+    with db.begin(write=True) as txn:
+        for i, record in enumerate(records):
+            if codec is not None:
+                record = CompressedRecord(record, codec)
+            txn.put(str(i).encode("ascii"), pickle.dumps(record, protocol=-1))
+    db.sync()
+    db.close()
+
+
+def drop_cache(path: Path) -> bool:
+    """Evict `path` from the page cache, returning whether that's supported."""
+    try:
+        # Drops all clean caches, but needs root
+        Path("/proc/sys/vm/drop_caches").write_text("1")
+        return True
+    except OSError:
+        pass
+    if not hasattr(os, "posix_fadvise"):
+        return False
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+        os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+    finally:
+        os.close(fd)
+    return True
+
+
+def load_time(path: Path, n: int, repeats: int) -> float:
+    """Return the best time (in seconds) to read all `n` images of `path`."""
+    times = []
+    for _ in range(repeats):
+        drop_cache(path)
+        start = time.perf_counter()
+        db = lmdb.open(
+            str(path),
+            subdir=False,
+            readonly=True,
+            lock=False,
+            readahead=False,
+            meminit=False,
+        )
+        with db.begin() as txn:
+            for i in range(n):
+                pickle.loads(txn.get(str(i).encode("ascii")))
+        db.close()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("lmdb", help="preprocessed LMDB to benchmark")
+    parser.add_argument(
+        "--output-dir",
+        default=None,
+        help="directory to write the copies in (by default, the system temp dir)",
+    )
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    n = read_lmdb_metadata(args.lmdb, "length")
+    records = read_lmdb_records(args.lmdb, n)
+    print(f"{n} images from {args.lmdb}")
+    if not drop_cache(Path(args.lmdb)):
+        print("Warning: can't evict files from the page cache, reads may be cached")
+    print()
+
+    print(f"{'codec':>6} {'size (MB)':>10} {'ratio':>6} {'load (s)':>9} {'vs none':>8}")
+    with tempfile.TemporaryDirectory(dir=args.output_dir) as tmp:
+        results = {}
+        for codec in [None, *available_codecs()]:
+            path = Path(tmp) / f"{codec}.lmdb"
+            write(path, records, codec)
+            # The map size is allocated up front, so measure the data actually used
+            db = lmdb.open(str(path), subdir=False, readonly=True, lock=False)
+            info, stat = db.info(), db.stat()
+            db.close()
+            size = (info["last_pgno"] + 1) * stat["psize"]
+            results[codec] = size, load_time(path, n, args.repeats)
+
+        base_size, base_time = results[None]
+        for codec, (size, seconds) in results.items():
+            print(
+                f"{codec or 'none':>6} {size / 1e6:>10.1f} {base_size / size:>6.2f} "
+                f"{seconds:>9.3f} {seconds / base_time:>7.2f}x"
+            )
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,6 @@
+from ampopt.finalize import finalize, load_ensemble
 from ampopt.jobs import run_pace_tuning_job, view_jobs
-from ampopt.preprocess import preprocess
+from ampopt.preprocess import append_to_lmdb, preprocess
 from ampopt.study import delete_studies, generate_report, view_studies
 from ampopt.tuning import tune
 from ampopt.train import eval_score
@@ -7,10 +8,13 @@ from ampopt.train import eval_score
 __all__ = [
     "tune",
     "preprocess",
+    "append_to_lmdb",
     "delete_studies",
     "generate_report",
     "view_studies",
     "run_pace_tuning_job",
     "view_jobs",
     "eval_score",
+    "finalize",
+    "load_ensemble",
 ]
\ No newline at end of file
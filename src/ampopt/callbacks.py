@@ -0,0 +1,249 @@
+"""
+Skorch callbacks used during training.
+"""
+
+import copy
+import json
+import time
+from pathlib import Path
+
+import optuna
+import torch
+from skorch.callbacks import Callback
+
+
+class CallbackList(Callback):
+    """
+    Combine several callbacks into one.
+
+    amptorch only accepts a single `custom_callback`, so this is used to pass it
+    several.
+    """
+
+    def __init__(self, callbacks):
+        self.callbacks = callbacks
+
+    def initialize(self):
+        for callback in self.callbacks:
+            callback.initialize()
+        return self
+
+    def on_train_begin(self, net, **kwargs):
+        for callback in self.callbacks:
+            callback.on_train_begin(net, **kwargs)
+
+    def on_train_end(self, net, **kwargs):
+        for callback in self.callbacks:
+            callback.on_train_end(net, **kwargs)
+
+    def on_epoch_begin(self, net, **kwargs):
+        for callback in self.callbacks:
+            callback.on_epoch_begin(net, **kwargs)
+
+    def on_epoch_end(self, net, **kwargs):
+        for callback in self.callbacks:
+            callback.on_epoch_end(net, **kwargs)
+
+    def on_batch_begin(self, net, **kwargs):
+        for callback in self.callbacks:
+            callback.on_batch_begin(net, **kwargs)
+
+    def on_batch_end(self, net, **kwargs):
+        for callback in self.callbacks:
+            callback.on_batch_end(net, **kwargs)
+
+    def on_grad_computed(self, net, named_parameters, **kwargs):
+        for callback in self.callbacks:
+            callback.on_grad_computed(net, named_parameters, **kwargs)
+
+
+class DeadlineCallback(Callback):
+    """
+    Stop training if the next epoch is not expected to finish before `deadline`.
+
+    The trial is pruned, and the number of epochs it completed is saved in its
+    `stopped_at_deadline` user attribute.
+
+    Args:
+        trial: the optuna trial being trained
+        deadline: time (as returned by `time.time()`) by which training must finish
+    """
+
+    def __init__(self, trial, deadline: float):
+        self.trial = trial
+        self.deadline = deadline
+
+    def initialize(self):
+        self.longest_epoch_ = 0.0
+        return self
+
+    def on_epoch_begin(self, net, **kwargs):
+        self.epoch_start_ = time.time()
+
+    def on_epoch_end(self, net, **kwargs):
+        now = time.time()
+        self.longest_epoch_ = max(self.longest_epoch_, now - self.epoch_start_)
+        if now + self.longest_epoch_ > self.deadline:
+            n_epochs = len(net.history)
+            self.trial.set_user_attr("stopped_at_deadline", n_epochs)
+            raise optuna.TrialPruned(
+                f"Stopped after {n_epochs} epochs to finish before the deadline"
+            )
+
+
+class PlateauStoppingCallback(Callback):
+    """
+    Stop training once `monitor` hasn't improved for `patience` epochs.
+
+    An epoch only counts as an improvement if it lowers the best score so far by more
+    than a fraction `tolerance` of it. When training stops, the model's parameters
+    are restored to those of the best epoch, and the number of epochs which weren't
+    run (out of `max_epochs`) is saved in the trial's `epochs_saved` user attribute.
+
+    Unlike pruning, this doesn't compare the trial to other trials, so it also works
+    with no pruner.
+
+    It should come before `ResumeCallback`, so that the restored parameters are the
+    ones which are saved. If `checkpoint_dir` is given, the parameters of the best
+    epoch are also saved there, so that they can be restored if the best epoch came
+    before training was resumed. `restored_` is True if the best epoch's parameters
+    were restored.
+
+    Args:
+        trial: the optuna trial being trained
+        max_epochs: the number of epochs the trial would otherwise train for
+        patience: number of epochs without improvement after which to stop
+        tolerance: minimum relative improvement
+        monitor: the key in the history to monitor (lower is better)
+        checkpoint_dir: directory to save the best epoch's parameters to
+    """
+
+    def __init__(
+        self,
+        trial,
+        max_epochs: int,
+        patience: int,
+        tolerance: float = 0.0,
+        monitor: str = "val_energy_mae",
+        checkpoint_dir=None,
+    ):
+        self.trial = trial
+        self.max_epochs = max_epochs
+        self.patience = patience
+        self.tolerance = tolerance
+        self.monitor = monitor
+        self.checkpoint_dir = checkpoint_dir
+
+    def initialize(self):
+        self.best_params_ = None
+        self.stopped_ = False
+        self.restored_ = False
+        return self
+
+    def _best_params_path(self):
+        return Path(self.checkpoint_dir) / "best_params.pt"
+
+    def best_epoch(self, scores) -> int:
+        """Return the (1-based) epoch of the best of `scores`, within the tolerance."""
+        best_score, best_epoch = float("inf"), 0
+        for epoch, score in enumerate(scores, 1):
+            if score < best_score * (1 - self.tolerance):
+                best_score, best_epoch = score, epoch
+        return best_epoch
+
+    def on_epoch_end(self, net, **kwargs):
+        # The whole history is used, so that resumed training carries on from it
+        epoch = len(net.history)
+        best_epoch = self.best_epoch(net.history[:, self.monitor])
+        if best_epoch == epoch:
+            self.best_params_ = copy.deepcopy(net.module_.state_dict())
+            if self.checkpoint_dir is not None:
+                self._best_params_path().parent.mkdir(parents=True, exist_ok=True)
+                torch.save(self.best_params_, self._best_params_path())
+        elif epoch - best_epoch >= self.patience:
+            self.stopped_ = True
+            epochs_saved = self.max_epochs - epoch
+            self.trial.set_user_attr("epochs_saved", epochs_saved)
+            print(
+                f"Stopping after epoch {epoch}: {self.monitor} hasn't improved since "
+                f"epoch {best_epoch} (saved {epochs_saved} epochs)"
+            )
+            # skorch stops training without an error on KeyboardInterrupt
+            raise KeyboardInterrupt
+
+    def on_train_end(self, net, **kwargs):
+        if not self.stopped_:
+            return
+        best_params = self.best_params_
+        # The best epoch may predate resuming, in which case they're only on disk
+        if (
+            best_params is None
+            and self.checkpoint_dir is not None
+            and self._best_params_path().exists()
+        ):
+            best_params = torch.load(self._best_params_path())
+        if best_params is not None:
+            net.module_.load_state_dict(best_params)
+            self.restored_ = True
+
+
+class ResumeCallback(Callback):
+    """
+    Save the training state after every epoch, and restore it when training starts.
+
+    The model, optimizer and history are saved with skorch, and the state of the
+    learning rate scheduler alongside them, so that a trial which was killed can be
+    resumed from its last completed epoch.
+
+    Args:
+        checkpoint_dir: directory to save the training state to
+    """
+
+    def __init__(self, checkpoint_dir):
+        self.checkpoint_dir = Path(checkpoint_dir)
+
+    def _paths(self):
+        return {
+            "f_params": self.checkpoint_dir / "params.pt",
+            "f_optimizer": self.checkpoint_dir / "optimizer.pt",
+            "f_history": self.checkpoint_dir / "history.json",
+        }
+
+    def _scheduler(self, net):
+        for _, callback in net.callbacks_:
+            if getattr(callback, "lr_scheduler_", None) is not None:
+                return callback.lr_scheduler_
+        return None
+
+    def on_train_begin(self, net, **kwargs):
+        if not (self.checkpoint_dir / "history.json").exists():
+            return
+        net.load_params(**self._paths())
+        scheduler = self._scheduler(net)
+        if scheduler is not None:
+            scheduler.load_state_dict(torch.load(self.checkpoint_dir / "scheduler.pt"))
+        print(f"Resumed training from epoch {len(net.history)}")
+
+    def on_epoch_end(self, net, **kwargs):
+        self._save(net)
+
+    def on_train_end(self, net, **kwargs):
+        # Callbacks before this one may have changed the model (or stopped training
+        # before the last epoch was saved)
+        self._save(net)
+
+    def _save(self, net):
+        self.checkpoint_dir.mkdir(parents=True, exist_ok=True)
+        net.save_params(**self._paths())
+        scheduler = self._scheduler(net)
+        if scheduler is not None:
+            torch.save(scheduler.state_dict(), self.checkpoint_dir / "scheduler.pt")
+
+
+def completed_epochs(checkpoint_dir) -> int:
+    """Return the number of epochs saved in `checkpoint_dir` by `ResumeCallback`."""
+    path = Path(checkpoint_dir) / "history.json"
+    if not path.exists():
+        return 0
+    with open(path) as f:
+        return len(json.load(f))
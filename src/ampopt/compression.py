@@ -0,0 +1,77 @@
+"""
+Compression of the records stored in LMDBs.
+
+A compressed record is pickled as a call to `decompress_record`, so unpickling it
+returns the original object. Any code which reads LMDB records with `pickle.loads`,
+including amptorch's datasets, therefore reads compressed LMDBs transparently.
+"""
+
+import bz2
+import lzma
+import pickle
+import zlib
+from functools import lru_cache
+from typing import Any, Callable, Dict, Tuple
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+
+@lru_cache(maxsize=None)
+def available_codecs() -> Dict[str, Tuple[Callable, Callable]]:
+    """
+    Return mapping of codec name to (compress, decompress) functions.
+
+    The mapping (and the zstd compressor and decompressor in it) is built once, since
+    it's looked up for every record read.
+    """
+    codecs = {
+        "zlib": (lambda b: zlib.compress(b, 1), zlib.decompress),
+        "lzma": (lzma.compress, lzma.decompress),
+        "bz2": (bz2.compress, bz2.decompress),
+    }
+    if lz4 is not None:
+        codecs["lz4"] = (lz4.frame.compress, lz4.frame.decompress)
+    if zstandard is not None:
+        codecs["zstd"] = (
+            zstandard.ZstdCompressor(level=3).compress,
+            zstandard.ZstdDecompressor().decompress,
+        )
+    return codecs
+
+
+def get_codec(codec: str) -> Tuple[Callable, Callable]:
+    codecs = available_codecs()
+    try:
+        return codecs[codec]
+    except KeyError:
+        raise ValueError(
+            f"codec={codec} not available; must be one of {list(codecs)} "
+            "(lz4 and zstd require the lz4 and zstandard packages)"
+        )
+
+
+def decompress_record(codec: str, payload: bytes) -> Any:
+    _, decompress = get_codec(codec)
+    return pickle.loads(decompress(payload))
+
+
+class CompressedRecord:
+    """Wrapper which pickles `obj` compressed with `codec`."""
+
+    def __init__(self, obj: Any, codec: str):
+        compress, _ = get_codec(codec)
+        raw = pickle.dumps(obj, protocol=-1)
+        self.codec = codec
+        self.raw_size = len(raw)
+        self.payload = compress(raw)
+
+    def __reduce__(self):
+        return decompress_record, (self.codec, self.payload)
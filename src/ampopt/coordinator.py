@@ -0,0 +1,334 @@
+"""
+Central ask-and-tell coordination of parallel tuning jobs.
+
+Instead of every job running its own `study.optimize` (each with its own sampler, and
+each querying the DB for every ask, tell and intermediate value), one coordinator
+process owns the study and its sampler. It hands hyperparameters to worker
+processes over a local connection, and the workers send back intermediate values
+and results, which the coordinator writes to the DB in batches.
+
+Messages sent by workers are tuples whose first element is one of:
+
+- "report", trial number, value, step
+- "should_prune", trial number (the coordinator replies with a bool)
+- "user_attr", trial number, key, value
+- "complete", trial number, value(s)
+- "pruned", trial number
+- "failed", trial number, error message
+
+The coordinator sends workers either ("trial", trial number, hyperparameters, user
+attributes) or ("stop",).
+"""
+
+import copy
+import os
+import subprocess
+import threading
+import time
+import traceback
+from multiprocessing.connection import Client, Listener, wait
+from typing import Any, Dict
+
+import optuna
+from optuna.trial import FixedTrial, TrialState
+
+from ampopt.study import estimate_trial_duration
+from ampopt.train import mk_objective, searches_descriptor, suggest_params
+from ampopt.utils import format_params
+
+# Environment variable used to pass the connection's authentication key to workers
+AUTHKEY_VAR = "AMPOPT_AUTHKEY"
+
+
+class WorkerTrial(FixedTrial):
+    """
+    Trial with hyperparameters fixed by the coordinator.
+
+    Intermediate values, pruning decisions and user attributes are forwarded to the
+    coordinator.
+    """
+
+    def __init__(
+        self, params: Dict[str, Any], number: int, conn, user_attrs: Dict[str, Any]
+    ):
+        super().__init__(params, number=number)
+        self._conn = conn
+        # Retried trials inherit user attributes, which the objective needs to see
+        for key, value in user_attrs.items():
+            super().set_user_attr(key, value)
+
+    def report(self, value: float, step: int) -> None:
+        self._conn.send(("report", self.number, value, step))
+
+    def should_prune(self) -> bool:
+        self._conn.send(("should_prune", self.number))
+        return self._conn.recv()
+
+    def set_user_attr(self, key: str, value: Any) -> None:
+        super().set_user_attr(key, value)
+        self._conn.send(("user_attr", self.number, key, value))
+
+
+def coordinate(
+    study,
+    storage,
+    n_trials: int,
+    jobs: int,
+    data: str,
+    n_epochs: int,
+    params_dict: Dict[str, Any],
+    verbose: bool,
+    precision: str = None,
+    multi_objective: bool = False,
+    time_budget: float = None,
+    auto_batch_size: bool = False,
+    memory_limit: int = None,
+    early_stopping_patience: int = None,
+    early_stopping_tol: float = 0.0,
+    memory_budget: int = None,
+    torchscript: bool = False,
+    flush_interval: float = 10.0,
+    connect_timeout: float = 600.0,
+):
+    """
+    Run `n_trials` trials of `study` (stored in the RDB storage `storage`) on `jobs`
+    worker processes.
+
+    Intermediate values are buffered, and written to the DB every `flush_interval`
+    seconds and when their trial finishes. Whether to prune a trial is decided from
+    its stored and buffered values, without waiting for them to be written.
+
+    Like `study.optimize`, the coordinator records heartbeats for the trials it's
+    running, and fails (and, via the storage's failed trial callback, retries) stale
+    trials before asking for new ones, so trials of a killed coordinator are retried
+    by the next job. Trials whose worker dies are failed and retried the same way.
+
+    If the workers haven't all connected within `connect_timeout` seconds, or one
+    of them exits before connecting, they're stopped and no trials are run.
+
+    If `time_budget` (in seconds) is given, trials are only started if they're
+    expected to finish within it, and running trials are stopped just before it runs
+    out.
+    """
+    deadline = None if time_budget is None else time.time() + time_budget
+    authkey = os.urandom(16)
+    listener = Listener(("localhost", 0), authkey=authkey)
+    host, port = listener.address
+
+    cmd = ["ampopt", "tune-worker"]
+    cmd += ["--address", f"{host}:{port}"]
+    cmd += ["--data", data]
+    cmd += ["--epochs", str(n_epochs)]
+    cmd += ["--verbose" if verbose else "--no-verbose"]
+    if params_dict:
+        cmd += ["--params", format_params(**params_dict)]
+    if precision is not None:
+        cmd += ["--precision", precision]
+    if multi_objective:
+        cmd += ["--multi-objective"]
+    if deadline is not None:
+        cmd += ["--deadline", str(deadline)]
+    if auto_batch_size:
+        cmd += ["--auto-batch-size"]
+    if memory_limit is not None:
+        cmd += ["--memory-limit", str(memory_limit)]
+    if early_stopping_patience is not None:
+        cmd += ["--early-stopping-patience", str(early_stopping_patience)]
+        cmd += ["--early-stopping-tol", str(early_stopping_tol)]
+    if memory_budget is not None:
+        cmd += ["--memory-budget", str(memory_budget)]
+    if torchscript:
+        cmd += ["--torchscript"]
+
+    processes = []
+    for i in range(jobs):
+        env = {**os.environ, "CUDA_VISIBLE_DEVICES": str(i), AUTHKEY_VAR: authkey.hex()}
+        processes.append(subprocess.Popen(cmd, env=env))
+
+    # Accept connections in a thread, so that workers which fail to start are noticed
+    conns = []
+    accepting = threading.Thread(
+        target=lambda: conns.extend(listener.accept() for _ in range(jobs)),
+        daemon=True,
+    )
+    accepting.start()
+    start = time.time()
+    while accepting.is_alive():
+        accepting.join(timeout=1.0)
+        exited = [p for p in processes if p.poll() is not None]
+        if accepting.is_alive() and (exited or time.time() - start > connect_timeout):
+            print(f"Only {len(conns)} of {jobs} workers connected")
+            print("Aborting")
+            for process in processes:
+                process.kill()
+            listener.close()
+            return
+    listener.close()
+    print(f"{jobs} workers connected")
+
+    search_descriptor = searches_descriptor(data)
+    idle = list(conns)
+    running = {}  # trial number -> (trial, connection)
+    pending = {}  # trial number -> buffered intermediate values, by step
+    last_flush = time.time()
+    last_heartbeat = time.time()
+    heartbeat = storage.is_heartbeat_enabled()
+    heartbeat_interval = storage.get_heartbeat_interval() if heartbeat else None
+    n_started = 0
+    out_of_time = False
+
+    def flush_trial(number):
+        trial, _ = running[number]
+        for step, value in sorted(pending.pop(number, {}).items()):
+            trial.report(value, step)
+
+    def flush():
+        nonlocal last_flush
+        for number in list(pending):
+            flush_trial(number)
+        last_flush = time.time()
+
+    def should_prune(number):
+        # Like Trial.should_prune, but with the values which haven't been written yet
+        trial, _ = running[number]
+        frozen = copy.deepcopy(storage.get_trial(trial._trial_id))
+        frozen.intermediate_values.update(pending.get(number, {}))
+        return study.pruner.prune(study, frozen)
+
+    def record_heartbeats():
+        nonlocal last_heartbeat
+        for trial, _ in running.values():
+            storage.record_heartbeat(trial._trial_id)
+        last_heartbeat = time.time()
+
+    def retry(trial):
+        # Retry the trial like fail_stale_trials does, with its params and user attrs
+        callback = storage.get_failed_trial_callback()
+        if callback is not None:
+            callback(study, copy.deepcopy(storage.get_trial(trial._trial_id)))
+
+    def finish(number, **tell_kwargs):
+        flush_trial(number)
+        trial, conn = running.pop(number)
+        study.tell(trial, **tell_kwargs)
+        return conn
+
+    while running or (idle and n_started < n_trials and not out_of_time):
+        while idle and n_started < n_trials and not out_of_time:
+            if deadline is not None:
+                estimate = estimate_trial_duration(study)
+                if estimate is not None and time.time() + estimate > deadline:
+                    print("Not starting more trials: not enough time budget left")
+                    out_of_time = True
+                    break
+
+            conn = idle.pop()
+            if heartbeat:
+                optuna.storages.fail_stale_trials(study)
+            trial = study.ask()
+            hparams = suggest_params(
+                trial, params_dict, search_descriptor=search_descriptor
+            )
+            running[trial.number] = (trial, conn)
+            if heartbeat:
+                storage.record_heartbeat(trial._trial_id)
+            conn.send(("trial", trial.number, hparams, trial.user_attrs))
+            n_started += 1
+
+        busy = [conn for _, conn in running.values()]
+        for conn in wait(busy, timeout=flush_interval):
+            try:
+                kind, number, *args = conn.recv()
+            except (EOFError, OSError):
+                # The worker died, so fail and retry its trial, and stop using it
+                number = next(n for n, (_, c) in running.items() if c is conn)
+                print(f"Worker running trial {number} died")
+                trial, _ = running[number]
+                finish(number, state=TrialState.FAIL)
+                retry(trial)
+                continue
+
+            trial, _ = running[number]
+            if kind == "report":
+                value, step = args
+                pending.setdefault(number, {})[step] = value
+            elif kind == "should_prune":
+                try:
+                    conn.send(should_prune(number))
+                except OSError:
+                    # The worker died; its trial is failed once the EOF is received
+                    pass
+            elif kind == "user_attr":
+                trial.set_user_attr(*args)
+            elif kind == "complete":
+                (values,) = args
+                idle.append(finish(number, values=values, state=TrialState.COMPLETE))
+            elif kind == "pruned":
+                idle.append(finish(number, state=TrialState.PRUNED))
+            elif kind == "failed":
+                print(f"Trial {number} failed: {args[0]}")
+                idle.append(finish(number, state=TrialState.FAIL))
+
+        if pending and time.time() - last_flush > flush_interval:
+            flush()
+        if heartbeat and time.time() - last_heartbeat > heartbeat_interval:
+            record_heartbeats()
+
+    for conn in idle:
+        conn.send(("stop",))
+        conn.close()
+
+
+def work(
+    address: str,
+    data: str,
+    n_epochs: int,
+    params_dict: Dict[str, Any],
+    verbose: bool,
+    precision: str = None,
+    multi_objective: bool = False,
+    deadline: float = None,
+    auto_batch_size: bool = False,
+    memory_limit: int = None,
+    early_stopping_patience: int = None,
+    early_stopping_tol: float = 0.0,
+    memory_budget: int = None,
+    torchscript: bool = False,
+):
+    """Run trials handed out by the coordinator listening on `address`."""
+    host, port = address.rsplit(":", 1)
+    authkey = bytes.fromhex(os.environ[AUTHKEY_VAR])
+    conn = Client((host, int(port)), authkey=authkey)
+
+    objective = mk_objective(
+        verbose=verbose,
+        epochs=n_epochs,
+        train_fname=data,
+        precision=precision,
+        multi_objective=multi_objective,
+        deadline=deadline,
+        auto_batch_size=auto_batch_size,
+        memory_limit=memory_limit,
+        early_stopping_patience=early_stopping_patience,
+        early_stopping_tol=early_stopping_tol,
+        memory_budget=memory_budget,
+        torchscript=torchscript,
+        **params_dict,
+    )
+
+    while True:
+        kind, *args = conn.recv()
+        if kind == "stop":
+            break
+        number, hparams, user_attrs = args
+        try:
+            values = objective(WorkerTrial(hparams, number, conn, user_attrs))
+        except optuna.TrialPruned:
+            conn.send(("pruned", number))
+        except Exception as e:
+            traceback.print_exc()
+            conn.send(("failed", number, repr(e)))
+        else:
+            conn.send(("complete", number, values))
+
+    conn.close()
@@ -0,0 +1,280 @@
+"""
+Retraining and evaluation of the best configurations found by a study.
+
+The top trials of a study are retrained for longer, in parallel worker processes
+(one per GPU, or per group of CPU cores), and scored on a holdout set. The results
+are saved to the study's `finalized` user attribute, from which the retrained models
+can be loaded as an ensemble.
+"""
+
+import json
+import os
+import subprocess
+import tempfile
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Sequence
+from uuid import uuid4
+
+import numpy as np
+import torch
+from optuna.trial import FixedTrial, TrialState
+from sklearn.metrics import mean_absolute_error
+
+from ampopt.predict import predict_energies, unscaled_energies
+from ampopt.preprocess import read_lmdb_metadata, read_lmdb_records
+from ampopt.study import get_study
+from ampopt.train import (checkpoint_dir, load_trainer, mk_objective,
+                          searches_descriptor)
+from ampopt.utils import (absolute, format_params, is_login_node, num_gpus,
+                          parse_params, read_data)
+
+
+def top_trials(study, k: int) -> List:
+    """Return the `k` completed trials of `study` with the lowest MAE."""
+    trials = study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,))
+    return sorted(trials, key=lambda t: t.values[0])[:k]
+
+
+def trial_params(trial, params: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the hyperparameters `trial` was trained with, on top of `params`."""
+    params = {**params, **trial.params}
+    # Trials tuned with auto_batch_size record the batch size they were trained with
+    loader = trial.user_attrs.get("loader_settings")
+    if loader is not None:
+        params.setdefault("batch_size", loader["batch_size"])
+    return params
+
+
+def worker_slots(jobs: int) -> List[Dict[str, Any]]:
+    """
+    Return the environment variables and CPU cores of each of `jobs` workers.
+
+    With GPUs, each worker uses one GPU; otherwise, the available CPU cores are split
+    evenly between the workers.
+    """
+    if num_gpus() > 0:
+        return [
+            {"env": {"CUDA_VISIBLE_DEVICES": str(i % num_gpus())}, "cores": None}
+            for i in range(jobs)
+        ]
+    cores = sorted(os.sched_getaffinity(0))
+    groups = np.array_split(cores, min(jobs, len(cores)))
+    return [{"env": {}, "cores": [int(c) for c in group]} for group in groups]
+
+
+class Ensemble:
+    """Predict energies as the mean of the predictions of several trained models."""
+
+    def __init__(self, trainers: Sequence):
+        self.trainers = list(trainers)
+
+    def predict(self, imgs) -> List[float]:
+        """Predict the energies of (unfeaturized) images `imgs`."""
+        predictions = [
+            trainer.predict(imgs, disable_tqdm=True)["energy"]
+            for trainer in self.trainers
+        ]
+        return np.mean(predictions, axis=0).tolist()
+
+    def predict_energies(self, data_list: Sequence, batch_size: int = 256):
+        """Predict the energies of featurized `data_list`; see `predict_energies`."""
+        predictions = [
+            predict_energies(trainer, data_list, batch_size)
+            for trainer in self.trainers
+        ]
+        return np.mean(predictions, axis=0).tolist()
+
+
+def load_ensemble(study_name: str) -> Ensemble:
+    """Load the models retrained by `finalize` for `study_name` as an `Ensemble`."""
+    finalized = get_study(study_name).user_attrs["finalized"]
+    return Ensemble(
+        load_trainer(
+            finalized["data"],
+            result["checkpoint"],
+            precision=finalized["precision"],
+            **result["params"],
+        )
+        for result in finalized["results"]
+    )
+
+
+def holdout_score(ensemble: Ensemble, holdout: str) -> float:
+    """Return the MAE of `ensemble` on `holdout` (a raw data file or an LMDB)."""
+    if searches_descriptor(holdout):
+        imgs = read_data(holdout)
+        y_true = [img.get_potential_energy() for img in imgs]
+        return mean_absolute_error(y_true, ensemble.predict(imgs))
+
+    records = read_lmdb_records(holdout, read_lmdb_metadata(holdout, "length"))
+    y_true = unscaled_energies(records, read_lmdb_metadata(holdout, "target_scaler"))
+    return mean_absolute_error(y_true, ensemble.predict_energies(records))
+
+
+def finalize(
+    study: str,
+    data: str,
+    holdout: str,
+    top_k: int = 3,
+    epochs: int = 1000,
+    jobs: int = 1,
+    params: str = "",
+    ensemble: bool = False,
+    precision: str = None,
+    verbose: bool = False,
+):
+    """
+    Retrain the `top_k` best trials of `study` on `data`, and score them on `holdout`.
+
+    Each trial is retrained for `epochs` epochs, with its hyperparameters on top of
+    the fixed hyperparameters in `params` (as passed to `tune`). Up to `jobs` trials
+    are retrained at once, each on its own GPU, or on its own share of the CPU cores.
+
+    `holdout` is either a preprocessed LMDB, featurized with the same descriptor
+    settings as `data`, or (if the study searched the descriptor settings) a raw
+    data file.
+
+    The holdout MAE, training time and checkpoint directory of each model are saved
+    in the study's `finalized` user attribute. If `ensemble` is True, the MAE of the
+    mean of the models' predictions is also computed and saved; the ensemble can be
+    loaded later with `load_ensemble`.
+    """
+    if is_login_node():
+        print("Don't run finalization on the login node!")
+        print("Aborting")
+        return
+
+    data = absolute(data, root="cwd")
+    holdout = absolute(holdout, root="cwd")
+    study_name = study
+    study = get_study(study_name)
+    params_dict = parse_params(params)
+
+    trials = top_trials(study, top_k)
+    if not trials:
+        print(f"Study {study_name} has no completed trials")
+        print("Aborting")
+        return
+
+    print(f"Retraining the top {len(trials)} trials of {study_name}:")
+    print(f" - num epochs: {epochs}")
+    print(f" - holdout: {holdout}")
+    slots = worker_slots(jobs)
+    pending = list(trials)
+    running = {}  # slot index -> (trial, process, output path)
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        while pending or running:
+            for i, slot in enumerate(slots):
+                if i in running or not pending:
+                    continue
+                trial = pending.pop(0)
+                output = Path(tmp) / f"{trial.number}.json"
+                cmd = ["ampopt", "finalize-trial"]
+                cmd += ["--data", data]
+                cmd += ["--holdout", holdout]
+                cmd += ["--epochs", str(epochs)]
+                cmd += ["--number", str(trial.number)]
+                cmd += ["--params", format_params(**trial_params(trial, params_dict))]
+                cmd += ["--output", str(output)]
+                cmd += ["--verbose" if verbose else "--no-verbose"]
+                if precision is not None:
+                    cmd += ["--precision", precision]
+                if slot["cores"] is not None:
+                    cmd += ["--cores", ",".join(map(str, slot["cores"]))]
+                print(f"Retraining trial {trial.number}")
+                process = subprocess.Popen(cmd, env={**os.environ, **slot["env"]})
+                running[i] = (trial, process, output)
+
+            time.sleep(5)
+            for i, (trial, process, output) in list(running.items()):
+                if process.poll() is None:
+                    continue
+                del running[i]
+                if process.returncode != 0 or not output.exists():
+                    print(f"Retraining trial {trial.number} failed")
+                    continue
+                result = json.loads(output.read_text())
+                print(
+                    f"Trial {trial.number}: holdout MAE {result['holdout_mae']:.4g} "
+                    f"(retrained in {result['seconds']:.0f}s)"
+                )
+                results.append(result)
+
+    if not results:
+        print("No trials were retrained successfully")
+        return
+
+    finalized = {
+        "data": data,
+        "holdout": holdout,
+        "epochs": epochs,
+        "precision": precision,
+        "results": sorted(results, key=lambda r: r["holdout_mae"]),
+    }
+
+    if ensemble and len(results) > 1:
+        finalized["ensemble_holdout_mae"] = holdout_score(
+            Ensemble(
+                load_trainer(data, r["checkpoint"], precision=precision, **r["params"])
+                for r in results
+            ),
+            holdout,
+        )
+        print(f"Ensemble holdout MAE: {finalized['ensemble_holdout_mae']:.4g}")
+
+    study.set_user_attr("finalized", finalized)
+
+    print(f"Results saved to the `finalized` user attribute of study {study_name}:")
+    for result in finalized["results"]:
+        print(f"  - Trial {result['trial']}: holdout MAE {result['holdout_mae']:.4g}")
+        print(f"    Params: {result['params']}")
+        print(f"    Checkpoint: {result['checkpoint']}")
+
+
+def retrain_trial(
+    data: str,
+    holdout: str,
+    epochs: int,
+    number: int,
+    params: Dict[str, Any],
+    output: str,
+    cores: Sequence[int] = None,
+    precision: str = None,
+    verbose: bool = False,
+):
+    """Retrain trial `number` with `params`, and write its results to `output`."""
+    if cores:
+        os.sched_setaffinity(0, cores)
+        torch.set_num_threads(len(cores))
+
+    if searches_descriptor(holdout):
+        holdout_kwargs = {"valid_fname": holdout}
+    else:
+        holdout_kwargs = {"valid_lmdb": holdout}
+
+    objective = mk_objective(
+        verbose=verbose,
+        epochs=epochs,
+        train_fname=data,
+        precision=precision,
+        keep_checkpoints=True,
+        **holdout_kwargs,
+        **params,
+    )
+    identifier = f"final-{number}-{uuid4()}"
+    trial = FixedTrial({})
+    trial.set_user_attr("identifier", identifier)
+
+    start = time.time()
+    score = objective(trial)
+    result = {
+        "trial": number,
+        "params": params,
+        "holdout_mae": float(score),
+        "seconds": time.time() - start,
+        "checkpoint": str(checkpoint_dir(identifier).resolve()),
+    }
+    Path(output).write_text(json.dumps(result))
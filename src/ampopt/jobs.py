@@ -19,7 +19,19 @@ def run_pace_tuning_job(
     sampler: str = "CmaEs",
     params: str = "",
     epochs: int = 100,
+    time_budget: str = "",
+    memory_budget: str = "1.5gb",
 ):
+    """
+    Queue a tuning job on PACE.
+
+    `time_budget` is passed to `tune`; it should be a little less than the job's
+    walltime, so that the last trial isn't killed by the scheduler.
+
+    `memory_budget` is also passed to `tune`; it leaves room within the job's 2gb
+    memory request for the model and everything else, so that trials on large
+    datasets aren't killed by the scheduler for exceeding it.
+    """
     params_dict = parse_params(params, prefix="param_")
 
     data = absolute(data, root="cwd")
@@ -32,6 +44,8 @@ def run_pace_tuning_job(
         pruner=pruner,
         sampler=sampler,
         epochs=epochs,
+        time_budget=time_budget,
+        memory_budget=memory_budget,
         **params_dict,
     )
 
@@ -0,0 +1,173 @@
+"""
+Functions for evaluating trained models on large datasets.
+
+Images are read, featurized and predicted in fixed-size chunks, so the whole dataset
+never has to be held in memory at once.
+"""
+
+import csv
+import math
+import time
+from itertools import islice
+from typing import Dict, Iterable, Iterator, List, Sequence
+
+import torch
+from amptorch.dataset import DataCollater
+from amptorch.preprocessing import AtomsToData
+from ase import Atoms
+from tqdm import tqdm
+
+from ampopt.utils import iread_data
+
+
+def chunked(iterable: Iterable, size: int) -> Iterator[List]:
+    """Yield successive lists of at most `size` items from `iterable`."""
+    iterator = iter(iterable)
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+class RunningMetrics:
+    """Accumulate energy error metrics without keeping the predictions around."""
+
+    def __init__(self):
+        self.count = 0
+        self.abs_error = 0.0
+        self.sq_error = 0.0
+        self.max_error = 0.0
+        self.abs_error_per_atom = 0.0
+
+    def update(
+        self, y_true: Sequence[float], y_pred: Sequence[float], n_atoms: Sequence[int]
+    ):
+        for true, pred, n in zip(y_true, y_pred, n_atoms):
+            error = abs(pred - true)
+            self.count += 1
+            self.abs_error += error
+            self.sq_error += error ** 2
+            self.max_error = max(self.max_error, error)
+            self.abs_error_per_atom += error / n
+
+    def result(self) -> Dict[str, float]:
+        if self.count == 0:
+            raise ValueError("No images were evaluated")
+        return {
+            "energy_mae": self.abs_error / self.count,
+            "energy_rmse": math.sqrt(self.sq_error / self.count),
+            "energy_max_error": self.max_error,
+            "energy_per_atom_mae": self.abs_error_per_atom / self.count,
+            "n_images": self.count,
+        }
+
+
+def featurize(trainer, imgs: Sequence[Atoms]) -> List:
+    """Compute scaled fingerprints of `imgs` the same way `trainer.predict` does."""
+    a2d = AtomsToData(
+        descriptor=trainer.train_dataset.descriptor,
+        r_energy=False,
+        r_forces=False,
+        save_fps=False,
+        fprimes=False,
+        cores=1,
+    )
+    data_list = a2d.convert_all(imgs, disable_tqdm=True)
+    trainer.feature_scaler.norm(data_list, disable_tqdm=True)
+    return data_list
+
+
+def predict_energies(trainer, data_list: Sequence, batch_size: int) -> List[float]:
+    """Predict (unscaled) energies for featurized `data_list` in batches."""
+    collate_fn = DataCollater(train=False, forcetraining=False)
+    trainer.net.module.eval()
+    energies = []
+    with torch.no_grad():
+        for i in range(0, len(data_list), batch_size):
+            collated = collate_fn(data_list[i : i + batch_size]).to(trainer.device)
+            energy, _ = trainer.net.module([collated])
+            energy = trainer.target_scaler.denorm(energy.detach().cpu(), pred="energy")
+            energies.extend(energy.reshape(-1).tolist())
+    return energies
+
+
+def unscaled_energies(data_list: Sequence, target_scaler) -> List[float]:
+    """Return the energies stored in featurized `data_list`, undoing `target_scaler`."""
+    energies = torch.tensor([float(data.energy) for data in data_list])
+    return target_scaler.denorm(energies, pred="energy").reshape(-1).tolist()
+
+
+def measure_latency(trainer, data_list: Sequence, repeats: int = 5) -> float:
+    """
+    Return the inference time per atom (in seconds) of `trainer`'s model.
+
+    `data_list` is predicted as a single batch `repeats` times, after one warm-up
+    pass, and the fastest time is used.
+    """
+    n_atoms = sum(data.fingerprint.shape[0] for data in data_list)
+    batch_size = len(data_list)
+    predict_energies(trainer, data_list, batch_size)
+
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        predict_energies(trainer, data_list, batch_size)
+        times.append(time.perf_counter() - start)
+    return min(times) / n_atoms
+
+
+def stream_metrics(
+    trainer,
+    fname: str,
+    chunk_size: int = 1000,
+    batch_size: int = 256,
+    predictions_fname: str = None,
+    verbose: bool = True,
+) -> Dict[str, float]:
+    """
+    Evaluate `trainer` on the images in `fname` without loading them all at once.
+
+    Args:
+        trainer: the trained AtomsTrainer
+        fname: path to a file readable by ase
+        chunk_size: number of images to read and featurize at a time
+        batch_size: number of images per forward pass
+        predictions_fname: if given, per-image predictions are appended to this CSV
+            file as each chunk is evaluated
+        verbose: whether to show a progress bar
+
+    Returns:
+        dictionary mapping metric name to value
+    """
+    metrics = RunningMetrics()
+    writer = None
+    if predictions_fname is not None:
+        predictions_file = open(predictions_fname, "w", newline="")
+        writer = csv.writer(predictions_file)
+        writer.writerow(["index", "n_atoms", "energy", "predicted_energy"])
+
+    progress = tqdm(desc="Evaluating", unit=" images", disable=not verbose)
+    index = 0
+    try:
+        for chunk in chunked(iread_data(fname), chunk_size):
+            y_true = [img.get_potential_energy() for img in chunk]
+            n_atoms = [len(img) for img in chunk]
+            y_pred = predict_energies(trainer, featurize(trainer, chunk), batch_size)
+            metrics.update(y_true, y_pred, n_atoms)
+
+            if writer is not None:
+                writer.writerows(
+                    zip(range(index, index + len(chunk)), n_atoms, y_true, y_pred)
+                )
+                predictions_file.flush()
+
+            index += len(chunk)
+            progress.update(len(chunk))
+            progress.set_postfix(mae=metrics.abs_error / metrics.count)
+    finally:
+        progress.close()
+        if writer is not None:
+            predictions_file.close()
+
+    return metrics.result()
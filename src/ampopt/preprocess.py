@@ -2,32 +2,84 @@
 Functions and classes for preprocessing data.
 """
 
+import fcntl
+import hashlib
 import json
+import multiprocessing
+import os
 import pickle
 import re
+from concurrent.futures import ProcessPoolExecutor
 from functools import lru_cache
 from pathlib import Path
 from typing import Dict, Iterable, List, Sequence, Tuple
 
 import ase.io
 import lmdb
+import numpy as np
 import torch
 from amptorch.descriptor.GMP import GMP
 from amptorch.preprocessing import AtomsToData, FeatureScaler, TargetScaler
 from ase import Atoms
+from scipy.spatial import cKDTree
+from sklearn.decomposition import PCA
+from sklearn.feature_selection import VarianceThreshold
 from sklearn.pipeline import Pipeline
 from tqdm import tqdm
 from tqdm.contrib import tenumerate
 
-from ampopt.utils import absolute, ampopt_path, read_data
+from ampopt.compression import CompressedRecord, get_codec
+from ampopt.utils import absolute, ampopt_path, read_data, tensor_type
+
+# Suffix of the manifest files listing the shards of a sharded dataset
+MANIFEST_SUFFIX = ".manifest.json"
 
 
 def preprocess(
     train: str,
     *others: str,
     data_dir: str = None,
+    precision: str = "float64",
+    reduce: str = None,
+    n_components: float = None,
+    variance_threshold: float = 0.0,
+    n_gaussians: int = 8,
+    n_mcsh: int = 3,
+    cutoff: float = 5,
+    dedup: bool = False,
+    positions_tol: float = None,
+    energy_tol: float = None,
+    codec: str = None,
+    shards: int = 1,
 ) -> None:
-    """Scale, Compute GMP features and save to lmdb."""
+    """
+    Scale, Compute GMP features and save to lmdb.
+
+    If `dedup` is True, duplicate images are removed from each file before it is
+    featurized; see `deduplicate`. The indices of the kept images in the original file
+    are saved to the LMDB under `source_indices`.
+
+    `n_gaussians`, `n_mcsh` and `cutoff` configure the GMP descriptor; `n_gaussians`
+    must be one of the sigma sets in `data/GMP/sigmas.json`.
+
+    The features are computed and stored with the given `precision` (either "float32"
+    or "float64"), which is also recorded in the LMDB.
+
+    If `reduce` is "pca" or "variance", the scaled fingerprints are compressed by a
+    transform fitted to `train` (see `ReducerTransformer`), which is saved to the
+    LMDB and applied to all other files and at prediction time.
+
+    If `codec` is given (e.g. "zlib", or "lz4"/"zstd" if installed), each image's
+    features are compressed with it; see `ampopt.compression`.
+
+    If `shards` > 1, each file is split into that many LMDBs, listed in a manifest
+    `<name>.manifest.json`; see `save_sharded_lmdb`. The manifest can be used
+    anywhere an LMDB can. The shards of all files but `train` are featurized and
+    written in parallel; see `featurize_sharded_lmdb`.
+    """
+    default_tensor_type = tensor_type(precision)
+    if codec is not None:
+        get_codec(codec)
     fnames = [train] + list(others)
     fnames = [absolute(fname, root="cwd") for fname in fnames]
     print(f"Creating LMDBs from files {', '.join(fnames)}")
@@ -37,67 +89,403 @@ def preprocess(
     else:
         data_dir = Path(absolute(data_dir, root="cwd"))
     data_dir.mkdir(exist_ok=True)
-    lmdb_paths = [data_dir / f"{Path(fname).stem}.lmdb" for fname in fnames]
+    suffix = ".lmdb" if shards == 1 else MANIFEST_SUFFIX
+    lmdb_paths = [data_dir / f"{Path(fname).stem}{suffix}" for fname in fnames]
 
-    for path in lmdb_paths:
-        if path.exists():
-            print(f"{path} already exists, aborting")
+    for fname, path in zip(fnames, lmdb_paths):
+        # Shards may be left without a manifest if writing them was interrupted
+        shard_paths = list(data_dir.glob(f"{Path(fname).stem}-[0-9][0-9][0-9].lmdb"))
+        if path.exists() or (shards > 1 and shard_paths):
+            existing = path if path.exists() else shard_paths[0]
+            print(f"{existing} already exists, aborting")
+            print("(To add images to an existing LMDB, use append_to_lmdb)")
             return
 
     trajs = [read_data(fname) for fname in fnames]
+    source_indices = [None] * len(trajs)
+
+    if dedup:
+        for i, (fname, traj) in enumerate(zip(fnames, trajs)):
+            trajs[i], source_indices[i] = deduplicate(
+                traj, positions_tol=positions_tol, energy_tol=energy_tol
+            )
+            n_removed = len(traj) - len(trajs[i])
+            print(
+                f"Removed {n_removed} of {len(traj)} images from {fname} as duplicates"
+            )
 
-    torch.set_default_tensor_type(torch.DoubleTensor)
+    torch.set_default_tensor_type(default_tensor_type)
 
     print(f"Fitting to {train}...")
-    feats, featurizer = mk_feature_pipeline(trajs[0])
-    save_to_lmdb(feats, featurizer, lmdb_paths[0])
+    feats, featurizer = mk_feature_pipeline(
+        trajs[0],
+        n_gaussians=n_gaussians,
+        n_mcsh=n_mcsh,
+        cutoff=cutoff,
+        reduce=reduce,
+        n_components=n_components,
+        variance_threshold=variance_threshold,
+    )
+    save_sharded_lmdb(
+        feats,
+        featurizer,
+        lmdb_paths[0],
+        shards=shards,
+        precision=precision,
+        source_indices=source_indices[0],
+        codec=codec,
+    )
 
-    for fname, traj, lmdb_fname in list(zip(fnames, trajs, lmdb_paths))[1:]:
+    for fname, traj, lmdb_fname, indices in list(
+        zip(fnames, trajs, lmdb_paths, source_indices)
+    )[1:]:
         print(f"\nLooking at {fname}:")
-        feats = featurizer.transform(traj)
-        save_to_lmdb(feats, featurizer, lmdb_fname)
+        featurize_sharded_lmdb(
+            traj,
+            featurizer,
+            lmdb_fname,
+            shards=shards,
+            precision=precision,
+            source_indices=indices,
+            codec=codec,
+        )
+
+
+def append_to_lmdb(
+    data: str,
+    lmdb_path: str,
+    dedup: bool = False,
+    positions_tol: float = None,
+    energy_tol: float = None,
+    check_drift: bool = False,
+    drift_tol: float = 0.05,
+) -> None:
+    """
+    Featurize the images in `data` and append them to an existing LMDB.
+
+    The images are featurized with the descriptor setup, scalers (and feature
+    reducer) saved in the LMDB, which aren't refitted, and stored with its precision
+    and codec. If `lmdb_path` is the manifest of a sharded dataset, the images are
+    written to a new shard.
+
+    The index of each new image in `data` is appended to the LMDB's
+    `source_indices`, and `data` to its `source_files`: a list of (file, number of
+    images) pairs, in the order the images are stored. Images preprocessed from the
+    original file are listed with file None.
+
+    If `check_drift` is True, a warning is printed if more than a fraction
+    `drift_tol` of the new scaled features lie outside [0, 1] (the range of the
+    data the scaler was fitted to), or of the new scaled energies lie outside the
+    range of the (first 1000) existing ones. In that case, the scalers no longer
+    describe the data well, and it should be preprocessed from scratch.
+    """
+    data = absolute(data, root="cwd")
+    lmdb_path = Path(absolute(lmdb_path, root="cwd"))
+    if not lmdb_path.exists():
+        print(f"{lmdb_path} doesn't exist, aborting")
+        return
+
+    last_shard = lmdb_shards(lmdb_path)[-1]
+    metadata = {
+        key: read_lmdb_metadata(last_shard, key)
+        for key in frozen_metadata + ["length", "raw_bytes"]
+    }
+    precision = metadata["precision"] or "float64"
+    codec = metadata["codec"]
+    torch.set_default_tensor_type(tensor_type(precision))
+
+    imgs = read_data(data)
+    indices = list(range(len(imgs)))
+    if dedup:
+        n_imgs = len(imgs)
+        imgs, indices = deduplicate(
+            imgs, positions_tol=positions_tol, energy_tol=energy_tol
+        )
+        print(f"Removed {n_imgs - len(imgs)} of {n_imgs} images from {data}")
+
+    print(f"Appending {data} to {lmdb_path}:")
+    gmp = GMPTransformer.from_setup(metadata["descriptor_setup"], **a2d_kwargs)
+    feats = gmp.transform(imgs)
+
+    feature_scaler = metadata["feature_scaler"]
+    scalers = getattr(feature_scaler, "scalers", (feature_scaler,))
+    feats = scalers[0].norm(feats)
+    drifted = False
+    if check_drift:
+        fps = torch.cat([d.fingerprint for d in feats])
+        outside = ((fps < 0) | (fps > 1)).double().mean().item()
+        print(f"Fraction of scaled features outside [0, 1]: {outside:.4f}")
+        drifted |= outside > drift_tol
+    for scaler in scalers[1:]:
+        feats = scaler.norm(feats)
+    feats = metadata["target_scaler"].norm(feats)
+
+    if check_drift:
+        reference = read_lmdb_records(lmdb_path, 1000)
+        ref = torch.tensor([float(d.energy) for d in reference])
+        new = torch.tensor([float(d.energy) for d in feats])
+        outside = ((new < ref.min()) | (new > ref.max())).double().mean().item()
+        print(
+            f"Scaled energies: mean {new.mean():.3f} (existing {ref.mean():.3f}), "
+            f"std {new.std():.3f} (existing {ref.std():.3f}), "
+            f"fraction outside existing range {outside:.4f}"
+        )
+        drifted |= outside > drift_tol
+    if drifted:
+        print(
+            "Warning: the new images have drifted from the data the scalers were "
+            "fitted to; consider preprocessing the whole dataset again"
+        )
+
+    records = {}
+    raw_bytes = 0
+    if lmdb_path.name.endswith(MANIFEST_SUFFIX):
+        manifest = json.loads(lmdb_path.read_text())
+        name = lmdb_path.name[: -len(MANIFEST_SUFFIX)]
+        target = lmdb_path.parent / f"{name}-{len(manifest['shards']):03d}.lmdb"
+        start = 0
+        source_indices, source_files = [], []
+        records.update(
+            {key: metadata[key] for key in frozen_metadata if metadata[key] is not None}
+        )
+    else:
+        target = lmdb_path
+        start = metadata["length"]
+        # Without source indices, the LMDB holds every image of its original file
+        source_indices = read_lmdb_metadata(lmdb_path, "source_indices")
+        if source_indices is None:
+            source_indices = list(range(start))
+        source_files = read_lmdb_metadata(lmdb_path, "source_files", [[None, start]])
+
+    for i, f in enumerate(feats, start):
+        if codec is not None:
+            f = CompressedRecord(f, codec)
+            raw_bytes += f.raw_size
+        records[str(i)] = f
+    records["length"] = start + len(feats)
+    records["source_indices"] = source_indices + list(indices)
+    records["source_files"] = source_files + [[data, len(feats)]]
+    if codec is not None:
+        if start > 0:
+            raw_bytes += metadata["raw_bytes"] or 0
+        records["raw_bytes"] = raw_bytes
+
+    db = lmdb.open(
+        str(target),
+        map_size=64_393_216 * 2 * 12,
+        subdir=False,
+        meminit=False,
+        map_async=True,
+    )
+    # One transaction, so the LMDB is left unchanged if anything fails
+    with db.begin(write=True) as txn:
+        for key, val in tqdm(records.items(), desc="Writing data to LMDB"):
+            txn.put(key.encode("ascii"), pickle.dumps(val, protocol=-1))
+    db.sync()
+    db.close()
+
+    if target != lmdb_path:
+        manifest["shards"].append(target.name)
+        manifest["lengths"].append(len(feats))
+        lmdb_path.write_text(json.dumps(manifest, indent=2))
+
+    print(f"Appended {len(feats)} images to {target}")
+
+
+def image_hash(img: Atoms) -> str:
+    """Return a hash which is equal for identical images (including their energy)."""
+    h = hashlib.sha1()
+    h.update(img.numbers.tobytes())
+    h.update(np.ascontiguousarray(img.positions).tobytes())
+    h.update(np.ascontiguousarray(img.cell.array).tobytes())
+    h.update(img.pbc.tobytes())
+    h.update(np.float64(img.get_potential_energy()).tobytes())
+    return h.hexdigest()
 
 
-def mk_feature_pipeline(train_imgs: Sequence) -> Pipeline:
+def deduplicate(
+    imgs: Sequence[Atoms], positions_tol: float = None, energy_tol: float = None
+) -> Tuple[List[Atoms], List[int]]:
+    """
+    Remove duplicate images, keeping the first of each.
+
+    Exact duplicates are found by hashing. If `positions_tol` is given, an image is
+    also a duplicate of an earlier kept image with the same atoms, cell and pbc if no
+    atom has moved more than `positions_tol` (in each coordinate) and, if
+    `energy_tol` is given, their energies differ by at most `energy_tol`.
+
+    Near-duplicates are looked up in a k-d tree of the flattened positions of each
+    group of images with the same atoms, cell and pbc, so long trajectories of a
+    single system aren't compared pairwise.
+
+    Returns:
+        the kept images, and their indices in `imgs`
+    """
+    seen = set()
+    # Images grouped by (numbers, cell, pbc), to compare near-duplicates against
+    groups = {}
+    candidates = []
+
+    for idx, img in tenumerate(imgs, desc="Removing duplicates", unit=" images"):
+        h = image_hash(img)
+        if h in seen:
+            continue
+        seen.add(h)
+        candidates.append(idx)
+
+        if positions_tol is not None:
+            group_key = (
+                img.numbers.tobytes(),
+                np.round(img.cell.array, 6).tobytes(),
+                img.pbc.tobytes(),
+            )
+            groups.setdefault(group_key, []).append(idx)
+
+    dropped = set()
+    for group in groups.values():
+        if len(group) < 2:
+            continue
+        positions = np.stack([imgs[i].positions.ravel() for i in group])
+        energies = [imgs[i].get_potential_energy() for i in group]
+        tree = cKDTree(positions)
+        kept_in_group = np.zeros(len(group), dtype=bool)
+        for i, neighbours in enumerate(
+            tree.query_ball_point(positions, positions_tol, p=np.inf)
+        ):
+            if any(
+                j < i
+                and kept_in_group[j]
+                and (energy_tol is None or abs(energies[i] - energies[j]) <= energy_tol)
+                for j in neighbours
+            ):
+                dropped.add(group[i])
+            else:
+                kept_in_group[i] = True
+
+    kept_indices = [idx for idx in candidates if idx not in dropped]
+    kept = [imgs[idx] for idx in kept_indices]
+
+    return kept, kept_indices
+
+
+def cached_lmdb(
+    fname: str,
+    n_gaussians: int = 8,
+    n_mcsh: int = 3,
+    cutoff: float = 5,
+    precision: str = "float64",
+) -> str:
+    """
+    Return the path to an LMDB of `fname` featurized with the given GMP settings.
+
+    LMDBs are cached in `data/cache`, keyed by the source file and the descriptor
+    settings, so each configuration is only featurized once. If several processes ask
+    for the same configuration at once, one of them builds it while the others wait.
+    """
+    source = Path(fname).resolve()
+    stat = source.stat()
+    source_hash = hashlib.sha1(
+        f"{source}:{stat.st_size}:{stat.st_mtime_ns}".encode()
+    ).hexdigest()[:10]
+    # Format the cutoff as a float, so that e.g. a fixed 5 and a sampled 5.0 match
+    settings = f"g{n_gaussians}-m{n_mcsh}-c{float(cutoff):g}"
+    key = f"{source.stem}-{source_hash}-{settings}-{precision}"
+
+    cache_dir = ampopt_path / "data/cache"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    lmdb_path = cache_dir / f"{key}.lmdb"
+
+    if lmdb_path.exists():
+        return str(lmdb_path)
+
+    with open(cache_dir / f"{key}.lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not lmdb_path.exists():
+            print(f"Featurizing {source} into {lmdb_path}...")
+            torch.set_default_tensor_type(tensor_type(precision))
+            feats, featurizer = mk_feature_pipeline(
+                read_data(str(source)),
+                n_gaussians=n_gaussians,
+                n_mcsh=n_mcsh,
+                cutoff=cutoff,
+            )
+            # Write to a temporary file first so that a crashed build is never used
+            tmp_path = cache_dir / f"{key}.lmdb.tmp"
+            tmp_path.unlink(missing_ok=True)
+            save_to_lmdb(feats, featurizer, tmp_path, precision=precision)
+            os.replace(tmp_path, lmdb_path)
+            Path(f"{tmp_path}-lock").unlink(missing_ok=True)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return str(lmdb_path)
+
+
+# Arguments of amptorch's AtomsToData used to featurize images
+a2d_kwargs = {"r_energy": True, "r_forces": True, "save_fps": False, "fprimes": False}
+
+
+def mk_feature_pipeline(
+    train_imgs: Sequence,
+    n_gaussians: int = 8,
+    n_mcsh: int = 3,
+    cutoff: float = 5,
+    reduce: str = None,
+    n_components: float = None,
+    variance_threshold: float = 0.0,
+) -> Pipeline:
     """
     Compute fitted featurizer given train data.
 
     Args:
         train_imgs (Sequence): the training data
+        n_gaussians, n_mcsh, cutoff: the GMP descriptor settings
+        reduce (str): None, "pca" or "variance"; see `ReducerTransformer`
+        n_components (float): target dimension or explained variance for PCA
+        variance_threshold (float): minimum variance of features kept by "variance"
     Returns:
         preprocess_pipeline (Pipeline): the sklearn pipeline object
     """
-    featurizer_pipeline = Pipeline(
-        steps=[
-            (
-                "GMP",
-                GMPTransformer(
-                    n_gaussians=8,
-                    n_mcsh=3,
-                    cutoff=5,
-                    r_energy=True,
-                    r_forces=True,
-                    save_fps=False,
-                    fprimes=False,
-                ),
+    steps = [
+        (
+            "GMP",
+            GMPTransformer(
+                n_gaussians=n_gaussians,
+                n_mcsh=n_mcsh,
+                cutoff=cutoff,
+                **a2d_kwargs,
             ),
-            (
-                "FeatureScaler",
-                ScalerTransformer(
-                    FeatureScaler,
-                    forcetraining=False,
-                    scaling={"type": "normalize", "range": (0, 1)},
-                ),
+        ),
+        (
+            "FeatureScaler",
+            ScalerTransformer(
+                FeatureScaler,
+                forcetraining=False,
+                scaling={"type": "normalize", "range": (0, 1)},
+            ),
+        ),
+        (
+            "TargetScaler",
+            ScalerTransformer(
+                TargetScaler,
+                forcetraining=False,
             ),
+        ),
+    ]
+
+    if reduce is not None:
+        steps.insert(
+            2,
             (
-                "TargetScaler",
-                ScalerTransformer(
-                    TargetScaler,
-                    forcetraining=False,
+                "FeatureReducer",
+                ReducerTransformer(
+                    reduce,
+                    n_components=n_components,
+                    variance_threshold=variance_threshold,
                 ),
             ),
-        ]
-    )
+        )
+
+    featurizer_pipeline = Pipeline(steps=steps)
 
     transformed_data = featurizer_pipeline.fit_transform(train_imgs)
     return transformed_data, featurizer_pipeline
@@ -119,37 +507,158 @@ class ScalerTransformer:
         return self.scaler.norm(X)
 
 
+class FingerprintReducer:
+    """
+    Apply a fitted scikit-learn transform to the fingerprints of each image.
+
+    Has the same `norm` interface as amptorch's FeatureScaler, so that it can be
+    chained after it with `ChainedScaler`.
+    """
+
+    def __init__(self, transform):
+        self.transform = transform
+
+    def norm(self, data_list, disable_tqdm=False):
+        for data in tqdm(
+            data_list, desc="Reducing features", disable=disable_tqdm, unit=" images"
+        ):
+            fps = data.fingerprint
+            reduced = self.transform.transform(fps.detach().cpu().numpy())
+            data.fingerprint = torch.tensor(reduced, dtype=fps.dtype)
+        return data_list
+
+
+class ChainedScaler:
+    """
+    Apply several scalers one after another.
+
+    Saved to the LMDB as the feature scaler, so amptorch applies the whole chain
+    when making predictions.
+    """
+
+    def __init__(self, *scalers):
+        self.scalers = scalers
+
+    def norm(self, data_list, disable_tqdm=False):
+        for scaler in self.scalers:
+            data_list = scaler.norm(data_list, disable_tqdm=disable_tqdm)
+        return data_list
+
+
+class ReducerTransformer:
+    """
+    Scikit-learn compatible transformer which compresses the fingerprints.
+
+    If `method="pca"`, fingerprints are projected onto their principal components;
+    `n_components` is either the number of components to keep (if >= 1) or the
+    fraction of explained variance to keep (if < 1).
+
+    If `method="variance"`, features whose variance over the training set is at most
+    `variance_threshold` are dropped.
+    """
+
+    def __init__(self, method, n_components=None, variance_threshold=0.0):
+        if method == "pca":
+            if n_components is not None and n_components >= 1:
+                n_components = int(n_components)
+            self._transform = PCA(n_components=n_components)
+        elif method == "variance":
+            self._transform = VarianceThreshold(threshold=variance_threshold)
+        else:
+            raise ValueError(f"method={method} not allowed; must be pca or variance")
+
+    def fit(self, X, y=None):
+        fps = torch.cat([data.fingerprint for data in X]).detach().cpu().numpy()
+        self._transform.fit(fps)
+        self.reducer = FingerprintReducer(self._transform)
+        n_features = self._transform.transform(fps[:1]).shape[1]
+        print(f"Reducing fingerprints from {fps.shape[1]} to {n_features} features")
+        return self
+
+    def transform(self, X):
+        return self.reducer.norm(X)
+
+
 class GMPTransformer:
-    """Scikit-learn compatible wrapper for GMP descriptor."""
+    """
+    Scikit-learn compatible wrapper for GMP descriptor.
+
+    The descriptor is only set up for the elements present in the data it is fitted
+    to; transforming images with any other element raises a ValueError.
+    """
 
     def __init__(self, n_gaussians, n_mcsh, cutoff, **a2d_kwargs):
-        sigmas = sigmas_dict()[n_gaussians]
+        try:
+            sigmas = sigmas_dict()[n_gaussians]
+        except KeyError:
+            raise ValueError(
+                f"n_gaussians={n_gaussians} not allowed; "
+                f"must be one of {list(sigmas_dict())}"
+            )
 
         def mcsh_groups(i):
             return [1] if i == 0 else list(range(1, i + 1))
 
-        MCSHs = {
-            "MCSHs": {
-                str(i): {
-                    "groups": mcsh_groups(i),
-                    "sigmas": sigmas,
-                }
-                for i in range(n_mcsh)
-            },
-            "atom_gaussians": electron_densities(),
-            "cutoff": cutoff,
+        self._mcshs = {
+            str(i): {
+                "groups": mcsh_groups(i),
+                "sigmas": sigmas,
+            }
+            for i in range(n_mcsh)
         }
+        self._cutoff = cutoff
+        self._a2d_kwargs = a2d_kwargs
 
-        self.elements = list(electron_densities().keys())
-        self.a2d = AtomsToData(
-            descriptor=GMP(MCSHs=MCSHs, elements=self.elements), **a2d_kwargs
-        )
-        self.setup = ("gmp", MCSHs, {"cutoff": cutoff}, self.elements)
+    @classmethod
+    def from_setup(cls, setup, **a2d_kwargs):
+        """Return a fitted transformer with the `descriptor_setup` saved in an LMDB."""
+        _, MCSHs, params, elements = setup
+        self = cls.__new__(cls)
+        self._mcshs = MCSHs["MCSHs"]
+        self._cutoff = params["cutoff"]
+        self._a2d_kwargs = a2d_kwargs
+        self._set_up(elements, MCSHs["atom_gaussians"])
+        return self
 
     def fit(self, X, y=None):
+        elements = {
+            symbol
+            for img in tqdm(X, desc="Finding elements", unit=" images")
+            for symbol in img.get_chemical_symbols()
+        }
+        unsupported = elements - set(electron_densities())
+        if unsupported:
+            raise ValueError(
+                f"No valence Gaussians for elements {sorted(unsupported)} in "
+                f"{ampopt_path / 'data/GMP/valence_gaussians'}"
+            )
+
+        elements = sorted(elements)
+        self._set_up(elements, {el: electron_densities()[el] for el in elements})
         return self
 
+    def _set_up(self, elements, atom_gaussians):
+        self.elements = elements
+        MCSHs = {
+            "MCSHs": self._mcshs,
+            "atom_gaussians": atom_gaussians,
+            "cutoff": self._cutoff,
+        }
+        self.a2d = AtomsToData(
+            descriptor=GMP(MCSHs=MCSHs, elements=self.elements), **self._a2d_kwargs
+        )
+        self.setup = ("gmp", MCSHs, {"cutoff": self._cutoff}, self.elements)
+
     def transform(self, X):
+        elements = set(self.elements)
+        for idx, img in enumerate(X):
+            unknown = set(img.get_chemical_symbols()) - elements
+            if unknown:
+                raise ValueError(
+                    f"Image {idx} contains elements {sorted(unknown)} which weren't "
+                    f"in the data the descriptor was fitted to ({self.elements})"
+                )
+
         n = len(X)
         return [
             self.a2d.convert(img, idx=idx)
@@ -173,7 +682,14 @@ def sigmas_dict() -> Dict[int, List[int]]:
     return {int(k): v for k, v in d.items()}
 
 
-def save_to_lmdb(feats: Sequence, pipeline: Pipeline, lmdb_path: Path) -> None:
+def save_to_lmdb(
+    feats: Sequence,
+    pipeline: Pipeline,
+    lmdb_path: Path,
+    precision: str = "float64",
+    source_indices: Sequence[int] = None,
+    codec: str = None,
+) -> None:
     """
     Save the features and pipeline information to the lmdb file.
 
@@ -181,20 +697,45 @@ def save_to_lmdb(feats: Sequence, pipeline: Pipeline, lmdb_path: Path) -> None:
         feats: the features to save
         params: the parameters of the preprocess pipeline
         pipeline: the preprocess pipeline
+        precision: the floating point precision the features were computed with
+        source_indices: if the images were deduplicated, the index of each image in
+            the original file
+        codec: if given, compress each image's features with this codec
     """
 
     feature_scaler = pipeline.named_steps["FeatureScaler"]
     target_scaler = pipeline.named_steps["TargetScaler"]
     gmp = pipeline.named_steps["GMP"]
 
+    extras = {}
+    if "FeatureReducer" in pipeline.named_steps:
+        reducer = pipeline.named_steps["FeatureReducer"].reducer
+        feature_scaler = ChainedScaler(feature_scaler.scaler, reducer)
+        extras["feature_reducer"] = reducer
+    else:
+        feature_scaler = feature_scaler.scaler
+    if source_indices is not None:
+        extras["source_indices"] = list(source_indices)
+
+    records = {str(i): f for i, f in enumerate(feats)}
+    if codec is not None:
+        records = {
+            key: CompressedRecord(f, codec)
+            for key, f in tqdm(records.items(), desc=f"Compressing with {codec}")
+        }
+        extras["raw_bytes"] = sum(r.raw_size for r in records.values())
+
     to_save = {
-        **{str(i): f for i, f in enumerate(feats)},
+        **records,
         **{
             "length": len(feats),
-            "feature_scaler": feature_scaler.scaler,
+            "feature_scaler": feature_scaler,
             "target_scaler": target_scaler.scaler,
             "descriptor_setup": gmp.setup,
             "elements": gmp.elements,
+            "precision": precision,
+            "codec": codec,
+            **extras,
         },
     }
 
@@ -206,14 +747,277 @@ def save_to_lmdb(feats: Sequence, pipeline: Pipeline, lmdb_path: Path) -> None:
         map_async=True,
     )
 
+    stored_bytes = 0
     for key, val in tqdm(to_save.items(), desc="Writing data to LMDB"):
         txn = db.begin(write=True)
-        txn.put(key.encode("ascii"), pickle.dumps(val, protocol=-1))
+        data = pickle.dumps(val, protocol=-1)
+        if key in records:
+            stored_bytes += len(data)
+        txn.put(key.encode("ascii"), data)
         txn.commit()
 
     db.sync()
     db.close()
 
+    if codec is not None and stored_bytes:
+        print(
+            f"Compressed features with {codec}: {extras['raw_bytes']:,} -> "
+            f"{stored_bytes:,} bytes ({extras['raw_bytes'] / stored_bytes:.2f}x)"
+        )
+
+
+# Metadata which is fixed when an LMDB is created, and copied to appended shards
+frozen_metadata = [
+    "feature_scaler",
+    "target_scaler",
+    "descriptor_setup",
+    "elements",
+    "precision",
+    "codec",
+    "feature_reducer",
+]
+
+
+def shard_layout(path: Path, n: int, shards: int) -> Tuple[List[Path], np.ndarray]:
+    """
+    Return the paths of the shards of the manifest `path`, and their bounds.
+
+    `n` images are split into (at most) `shards` contiguous slices; shard `i` holds
+    the images from `bounds[i]` to `bounds[i + 1]`.
+    """
+    path = Path(path)
+    name = path.name[: -len(MANIFEST_SUFFIX)]
+    shards = max(1, min(shards, n))
+    bounds = np.linspace(0, n, shards + 1).astype(int)
+    shard_paths = [path.parent / f"{name}-{i:03d}.lmdb" for i in range(shards)]
+    return shard_paths, bounds
+
+
+def write_manifest(
+    path: Path, shard_paths: Sequence[Path], bounds: np.ndarray, precision: str, codec
+) -> None:
+    """Write the manifest `path` listing `shard_paths` (see `shard_layout`)."""
+    manifest = {
+        "shards": [p.name for p in shard_paths],
+        "lengths": [int(hi - lo) for lo, hi in zip(bounds[:-1], bounds[1:])],
+        "precision": precision,
+        "codec": codec,
+    }
+    Path(path).write_text(json.dumps(manifest, indent=2))
+    print(f"Wrote {bounds[-1]} images to {len(shard_paths)} shards listed in {path}")
+
+
+def save_sharded_lmdb(
+    feats: Sequence,
+    pipeline: Pipeline,
+    path: Path,
+    shards: int = 1,
+    precision: str = "float64",
+    source_indices: Sequence[int] = None,
+    codec: str = None,
+) -> None:
+    """
+    Save the features to `shards` LMDBs, and a manifest.
+
+    Each shard is a complete LMDB (see `save_to_lmdb`) of a contiguous slice of the
+    images. The shards are named `<name>-000.lmdb`, `<name>-001.lmdb`, ... next to
+    the manifest `path` (`<name>.manifest.json`), which lists them in order. Shard
+    paths in the manifest are relative to its directory, but may be edited to
+    absolute paths if the shards are moved to other filesystems.
+
+    If `shards` is 1, a single LMDB is written to `path` with no manifest.
+    """
+    if shards == 1:
+        save_to_lmdb(
+            feats,
+            pipeline,
+            path,
+            precision=precision,
+            source_indices=source_indices,
+            codec=codec,
+        )
+        return
+
+    shard_paths, bounds = shard_layout(path, len(feats), shards)
+    for shard_path, lo, hi in zip(shard_paths, bounds[:-1], bounds[1:]):
+        save_to_lmdb(
+            feats[lo:hi],
+            pipeline,
+            shard_path,
+            precision=precision,
+            source_indices=None if source_indices is None else source_indices[lo:hi],
+            codec=codec,
+        )
+    write_manifest(path, shard_paths, bounds, precision, codec)
+
+
+def _featurize_shard(
+    imgs: Sequence[Atoms],
+    pipeline: Pipeline,
+    path: Path,
+    precision: str,
+    source_indices: Sequence[int],
+    codec: str,
+) -> None:
+    torch.set_default_tensor_type(tensor_type(precision))
+    save_to_lmdb(
+        pipeline.transform(imgs),
+        pipeline,
+        path,
+        precision=precision,
+        source_indices=source_indices,
+        codec=codec,
+    )
+
+
+def featurize_sharded_lmdb(
+    imgs: Sequence[Atoms],
+    pipeline: Pipeline,
+    path: Path,
+    shards: int = 1,
+    precision: str = "float64",
+    source_indices: Sequence[int] = None,
+    codec: str = None,
+) -> None:
+    """
+    Featurize `imgs` with the fitted `pipeline`, and save them like `save_sharded_lmdb`.
+
+    If `shards` > 1, each shard is featurized, compressed and written by its own
+    process (up to one per CPU core).
+    """
+    if shards == 1:
+        _featurize_shard(imgs, pipeline, path, precision, source_indices, codec)
+        return
+
+    shard_paths, bounds = shard_layout(path, len(imgs), shards)
+    # Spawn rather than fork, since forking after torch has started threads can hang
+    with ProcessPoolExecutor(
+        max_workers=min(len(shard_paths), os.cpu_count()),
+        mp_context=multiprocessing.get_context("spawn"),
+    ) as pool:
+        futures = [
+            pool.submit(
+                _featurize_shard,
+                # Slices of ase trajectories keep the file open, so can't be pickled
+                list(imgs[lo:hi]),
+                pipeline,
+                shard_path,
+                precision,
+                None if source_indices is None else source_indices[lo:hi],
+                codec,
+            )
+            for shard_path, lo, hi in zip(shard_paths, bounds[:-1], bounds[1:])
+        ]
+        # So that exceptions raised while writing a shard are raised here
+        for future in futures:
+            future.result()
+    write_manifest(path, shard_paths, bounds, precision, codec)
+
+
+def lmdb_shards(lmdb_path: str) -> List[str]:
+    """
+    Return the paths of the LMDB files of the dataset at `lmdb_path`.
+
+    `lmdb_path` is either an LMDB, or the manifest of a sharded dataset.
+    """
+    path = Path(lmdb_path)
+    if not path.name.endswith(MANIFEST_SUFFIX):
+        return [str(path)]
+    manifest = json.loads(path.read_text())
+    return [str(path.parent / shard) for shard in manifest["shards"]]
+
+
+def read_lmdb_metadata(lmdb_path: str, key: str, default=None):
+    """
+    Return the value stored under `key` in the LMDB at `lmdb_path`.
+
+    If `lmdb_path` is the manifest of a sharded dataset, the lengths (and source
+    indices and files) of the shards are combined, and other metadata is read from
+    the first shard.
+    """
+    paths = lmdb_shards(lmdb_path)
+    combined = ("length", "raw_bytes", "source_indices", "source_files")
+    if len(paths) == 1 or key not in combined:
+        return _read_lmdb_metadata(paths[0], key, default)
+
+    values = [_read_lmdb_metadata(path, key) for path in paths]
+    if key in ("source_indices", "source_files") and any(values):
+        # Shards without them hold consecutive images of the original file, as
+        # written by preprocess without deduplication
+        offset = 0
+        for i, path in enumerate(paths):
+            if values[i] is None:
+                length = _read_lmdb_metadata(path, "length")
+                if key == "source_indices":
+                    values[i] = list(range(offset, offset + length))
+                else:
+                    values[i] = [[None, length]]
+                offset += length
+    if any(value is None for value in values):
+        return default
+    if key in ("source_indices", "source_files"):
+        return [i for value in values for i in value]
+    return sum(values)
+
+
+def lmdb_data_size(lmdb_path: str) -> List[int]:
+    """
+    Return the size (in bytes) of the uncompressed data in each shard of `lmdb_path`.
+
+    This is the `raw_bytes` recorded for compressed LMDBs, and otherwise the size of
+    the LMDB's pages in use.
+    """
+    sizes = []
+    for path in lmdb_shards(lmdb_path):
+        raw_bytes = _read_lmdb_metadata(path, "raw_bytes")
+        if raw_bytes is not None:
+            sizes.append(raw_bytes)
+            continue
+        db = lmdb.open(str(path), subdir=False, readonly=True, lock=False)
+        stat = db.stat()
+        db.close()
+        pages = stat["branch_pages"] + stat["leaf_pages"] + stat["overflow_pages"]
+        sizes.append(pages * stat["psize"])
+    return sizes
+
+
+def _read_lmdb_metadata(lmdb_path: str, key: str, default=None):
+    db = lmdb.open(
+        str(lmdb_path),
+        subdir=False,
+        readonly=True,
+        lock=False,
+        readahead=False,
+        meminit=False,
+    )
+    with db.begin() as txn:
+        val = txn.get(key.encode("ascii"))
+    db.close()
+    return default if val is None else pickle.loads(val)
+
+
+def read_lmdb_records(lmdb_path: str, n: int) -> List:
+    """Return (at most) the first `n` featurized images in the LMDB at `lmdb_path`."""
+    records = []
+    for path in lmdb_shards(lmdb_path):
+        n_shard = min(n - len(records), read_lmdb_metadata(path, "length"))
+        db = lmdb.open(
+            str(path),
+            subdir=False,
+            readonly=True,
+            lock=False,
+            readahead=False,
+            meminit=False,
+        )
+        with db.begin() as txn:
+            records += [
+                pickle.loads(txn.get(str(i).encode("ascii"))) for i in range(n_shard)
+            ]
+        db.close()
+        if len(records) >= n:
+            break
+    return records
+
 
 def save_to_traj(imgs: Iterable[Atoms], path: Path):
     """Save `imgs`."""
@@ -0,0 +1,50 @@
+"""
+TorchScript compilation of models, to cut Python overhead when training small models.
+
+The MLPs of amptorch's models (their `nn.Sequential` submodules) are compiled with
+`torch.jit.script`. Compiled submodules are cached per architecture, so trials with
+the same layer shapes reuse them (with their own weights) instead of recompiling.
+"""
+
+import copy
+from typing import Dict
+
+import torch
+from torch import nn
+
+# Scripted submodules, keyed by their architecture
+_scripted: Dict[str, torch.jit.ScriptModule] = {}
+
+
+def architecture_key(module: nn.Module) -> str:
+    """Return a key which is equal for modules with the same layers and dtype."""
+    dtypes = sorted({str(p.dtype) for p in module.parameters()})
+    return f"{module!r}|{','.join(dtypes)}"
+
+
+def script_module(module: nn.Module) -> torch.jit.ScriptModule:
+    """Return `module` compiled with TorchScript, with the same weights."""
+    key = architecture_key(module)
+    if key not in _scripted:
+        _scripted[key] = torch.jit.script(copy.deepcopy(module))
+    scripted = copy.deepcopy(_scripted[key])
+    scripted.load_state_dict(module.state_dict())
+    scripted.train(module.training)
+    return scripted
+
+
+def script_mlps(model: nn.Module) -> int:
+    """
+    Replace each `nn.Sequential` submodule of `model` by a scripted copy, in place.
+
+    The rest of the model (which handles amptorch's batches) stays in Python. Returns
+    the number of submodules replaced.
+    """
+    n_scripted = 0
+    for name, child in model.named_children():
+        if isinstance(child, nn.Sequential):
+            setattr(model, name, script_module(child))
+            n_scripted += 1
+        elif not isinstance(child, torch.jit.ScriptModule):
+            n_scripted += script_mlps(child)
+    return n_scripted
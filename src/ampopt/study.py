@@ -1,11 +1,16 @@
+import math
+import statistics
+import time
 from functools import lru_cache
 
 import optuna
 from dotenv import dotenv_values
 from optuna import visualization as viz
 from optuna.pruners import HyperbandPruner, MedianPruner, NopPruner
-from optuna.samplers import (CmaEsSampler, GridSampler, RandomSampler,
-                             TPESampler)
+from optuna.samplers import (CmaEsSampler, GridSampler, MOTPESampler,
+                             NSGAIISampler, RandomSampler, TPESampler)
+from optuna.storages import RDBStorage, RetryFailedTrialCallback, _CachedStorage
+from optuna.trial import TrialState
 
 from ampopt.utils import ampopt_path
 from sshtunnel import SSHTunnelForwarder
@@ -41,6 +46,49 @@ def connection_string() -> str:
     return f"mysql+pymysql://{username}:{password}@{sql_hostname}/{db}"
 
 
+def get_storage(heartbeat_interval: int = 60, max_retry: int = 3) -> RDBStorage:
+    """
+    Return the DB storage used for tuning.
+
+    Running trials record a heartbeat every `heartbeat_interval` seconds. Trials
+    whose heartbeat stops (e.g. because their job hit its walltime) are marked as
+    failed, and retried up to `max_retry` times by new trials with the same params
+    and user attributes; see `mk_objective` for how they resume training.
+    """
+    return RDBStorage(
+        connection_string(),
+        heartbeat_interval=heartbeat_interval,
+        grace_period=3 * heartbeat_interval,
+        failed_trial_callback=RetryFailedTrialCallback(max_retry=max_retry),
+    )
+
+
+class TrialHistoryCache(_CachedStorage):
+    """
+    Cached RDB storage which reads other processes' trials at most every so often.
+
+    optuna's `_CachedStorage` already keeps finished trials in memory, but every
+    `study.get_trials()` call still queries the IDs of all of the study's trials to
+    find new ones. Samplers call it several times per suggestion (TPE once per
+    parameter), so each suggestion makes several queries whose cost grows with the
+    study. Here, the DB is read at most once every `max_staleness` seconds; in
+    between, `get_trials()` returns the cached trials, which include all changes
+    made by this process.
+    """
+
+    def __init__(self, backend: RDBStorage, max_staleness: float = 1.0):
+        super().__init__(backend)
+        self.max_staleness = max_staleness
+        self._last_read = {}  # study ID -> time the study's trials were last read
+
+    def read_trials_from_remote_storage(self, study_id: int) -> None:
+        now = time.monotonic()
+        if now - self._last_read.get(study_id, -math.inf) < self.max_staleness:
+            return
+        super().read_trials_from_remote_storage(study_id)
+        self._last_read[study_id] = now
+
+
 def delete_study(study_name: str):
     optuna.delete_study(study_name=study_name, storage=connection_string())
     print(f"Deleted study {study_name}.")
@@ -59,7 +107,58 @@ def get_all_studies():
     return optuna.get_all_study_summaries(storage=connection_string())
 
 
-def get_or_create_study(study_name: str, sampler: str, pruner: str):
+# Objectives of multi-objective studies, in the order returned by the objective
+objective_names = ["MAE", "Latency per atom (s)", "Num parameters"]
+
+
+def is_multi_objective(study) -> bool:
+    return len(study.directions) > 1
+
+
+def get_or_create_study(
+    study_name: str,
+    sampler: str,
+    pruner: str,
+    multi_objective: bool = False,
+    storage: RDBStorage = None,
+):
+    """
+    Load the study `study_name`, creating it if it doesn't exist.
+
+    The study is stored in `storage` if given, or else a new `get_storage()`.
+
+    The study's trials are cached in memory, and read from the DB at most once a
+    second (see `TrialHistoryCache`), so that suggesting a trial doesn't query the
+    DB repeatedly.
+
+    If `multi_objective` is True, the study minimizes each of `objective_names`, and
+    must use the NSGAII, MOTPE or Random sampler. Multi-objective studies can't be
+    pruned, so `pruner` is ignored.
+    """
+    storage = storage if storage is not None else get_storage()
+
+    if multi_objective:
+        multi_objective_samplers = {
+            "NSGAII": NSGAIISampler(),
+            "MOTPE": MOTPESampler(n_startup_trials=40),
+            "Random": RandomSampler(),
+        }
+        if sampler not in multi_objective_samplers:
+            raise ValueError(
+                f"sampler={sampler} doesn't support multi-objective studies; "
+                f"must be one of {list(multi_objective_samplers)}"
+            )
+        if pruner != "None":
+            print("Multi-objective studies can't be pruned, ignoring pruner")
+
+        return optuna.create_study(
+            sampler=multi_objective_samplers[sampler],
+            directions=["minimize"] * len(objective_names),
+            study_name=study_name,
+            storage=TrialHistoryCache(storage),
+            load_if_exists=True,
+        )
+
     samplers = {
         "CmaEs": CmaEsSampler(n_startup_trials=10),
         "TPE": TPESampler(n_startup_trials=40),
@@ -79,15 +178,47 @@ def get_or_create_study(study_name: str, sampler: str, pruner: str):
         sampler=samplers[sampler],
         pruner=pruners[pruner],
         study_name=study_name,
-        storage=connection_string(),
+        storage=TrialHistoryCache(storage),
         load_if_exists=True,
     )
 
 
+def print_pareto_front(study):
+    trials = sorted(study.best_trials, key=lambda t: t.values)
+    print(f"  Pareto front ({len(trials)} trials):")
+    for trial in trials:
+        values = ", ".join(
+            f"{name}: {val:.4g}" for name, val in zip(objective_names, trial.values)
+        )
+        print(f"    - Trial {trial.number}: {values}")
+        print(f"      Params: {trial.params}")
+
+
+def estimate_trial_duration(study) -> float:
+    """
+    Estimate how long (in seconds) a new trial in `study` will take.
+
+    Uses the median duration of the study's completed trials, or None if there
+    aren't any.
+    """
+    durations = [
+        trial.duration.total_seconds()
+        for trial in study.get_trials(deepcopy=False, states=(TrialState.COMPLETE,))
+        if trial.duration is not None
+    ]
+    if not durations:
+        return None
+    return statistics.median(durations)
+
+
 def view_studies():
     studies = get_all_studies()
     for study in studies:
         print(f"Study {study.study_name}:")
+        if is_multi_objective(study):
+            print_pareto_front(get_study(study.study_name))
+            print(f"  Num trials: {study.n_trials}")
+            continue
         try:
             trial = study.best_trial
             assert trial is not None
@@ -110,6 +241,10 @@ def generate_report(study_name: str):
 
     study = get_study(study_name)
 
+    if is_multi_objective(study):
+        generate_multi_objective_report(study, report_dir)
+        return
+
     viz.plot_contour(study, params=["num_layers", "num_nodes"]).write_image(
         report_dir / "contour_plot.png"
     )
@@ -122,3 +257,25 @@ def generate_report(study_name: str):
 
     print(f"Best params: {study.best_params} with MAE {study.best_value}")
     print(f"Report saved to {report_dir}")
+
+
+def generate_multi_objective_report(study, report_dir):
+    viz.plot_pareto_front(study, target_names=objective_names).write_image(
+        report_dir / "pareto_front.png"
+    )
+
+    mae = {"target": lambda t: t.values[0], "target_name": "MAE"}
+
+    viz.plot_contour(study, params=["num_layers", "num_nodes"], **mae).write_image(
+        report_dir / "contour_plot.png"
+    )
+
+    viz.plot_optimization_history(study, **mae).write_image(report_dir / "history.png")
+
+    viz.plot_param_importances(study, **mae).write_image(
+        report_dir / "param_importance.png"
+    )
+
+    print(f"Study {study.study_name}:")
+    print_pareto_front(study)
+    print(f"Report saved to {report_dir}")
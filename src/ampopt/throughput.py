@@ -0,0 +1,236 @@
+"""
+Functions for finding the batch size and data loader settings which train fastest.
+
+Settings are found by timing a few training batches with each setting, on one
+trainer (so the dataset is only loaded once), and cached per dataset, hardware and
+model architecture in `data/cache/loader_settings`.
+"""
+
+import copy
+import fcntl
+import hashlib
+import json
+import math
+import os
+import platform
+import resource
+import time
+from pathlib import Path
+from typing import Any, Dict, Sequence
+
+import torch
+from amptorch.trainer import AtomsTrainer
+from skorch.dataset import unpack_data
+from torch.utils.data import Subset
+
+from ampopt.scripting import script_mlps
+from ampopt.utils import ampopt_path, num_gpus
+
+cache_dir = ampopt_path / "data/cache/loader_settings"
+
+
+def hardware() -> str:
+    """Return a description of the hardware training runs on."""
+    if num_gpus() > 0:
+        return torch.cuda.get_device_name(0)
+    return f"{platform.machine()}-{os.cpu_count()}cpus"
+
+
+def cache_key(config: Dict[str, Any], torchscript: bool = False) -> str:
+    """
+    Return the key for the dataset, hardware and architecture of `config`.
+
+    Scripted models train at a different speed, so `torchscript` is part of the key.
+    """
+    datasets = []
+    for path in config["dataset"]["lmdb_path"]:
+        stat = Path(path).stat()
+        datasets.append(f"{Path(path).resolve()}:{stat.st_size}:{stat.st_mtime_ns}")
+    model = config["model"]
+    architecture = f"{model['num_layers']}x{model['num_nodes']}"
+    cache = config["dataset"]["cache"]
+    compiled = "torchscript" if torchscript else "eager"
+    return "|".join([",".join(datasets), cache, hardware(), architecture, compiled])
+
+
+def reset_peak_memory() -> None:
+    """Start measuring peak memory use from the current usage."""
+    if num_gpus() > 0:
+        torch.cuda.reset_peak_memory_stats()
+        return
+    try:
+        # Resets the peak resident set size (VmHWM) of this process
+        Path("/proc/self/clear_refs").write_text("5")
+    except OSError:
+        pass
+
+
+def peak_memory() -> int:
+    """Return the peak memory used (in bytes) since `reset_peak_memory`."""
+    if num_gpus() > 0:
+        return torch.cuda.max_memory_allocated()
+    try:
+        for line in Path("/proc/self/status").read_text().splitlines():
+            if line.startswith("VmHWM:"):
+                return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    # Without /proc, fall back to the peak of the whole process so far (in kilobytes)
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def timing_trainer(config: Dict[str, Any], torchscript: bool = False) -> AtomsTrainer:
+    """
+    Return a trainer for `config` without its callbacks or checkpoints.
+
+    If `torchscript` is True, its model is compiled as in training (see
+    `ampopt.scripting`).
+    """
+    # Don't copy (or use) the trial's callbacks
+    cmd = {k: v for k, v in config["cmd"].items() if k != "custom_callback"}
+    config = copy.deepcopy({**config, "cmd": cmd})
+    config["cmd"]["debug"] = True
+    config["cmd"]["verbose"] = False
+    trainer = AtomsTrainer(config)
+    if torchscript:
+        script_mlps(trainer.net.module)
+    trainer.net.initialize()
+    return trainer
+
+
+def time_batches(
+    trainer: AtomsTrainer,
+    batch_size: int,
+    num_workers: int,
+    pin_memory: bool,
+    n_batches: int = 20,
+    warmup: int = 2,
+) -> Dict[str, float]:
+    """
+    Train `trainer` on `n_batches` batches with the given loader settings.
+
+    The first `warmup` batches (which include starting the loader workers) aren't
+    timed. Returns the training throughput (images per second), and the peak memory
+    used.
+    """
+    net = trainer.net
+    n_images = min(len(trainer.train_dataset), (warmup + n_batches) * batch_size)
+    subset = Subset(trainer.train_dataset, range(n_images))
+    warmup = min(warmup, math.ceil(n_images / batch_size) - 1)
+    net.set_params(
+        batch_size=batch_size,
+        iterator_train__num_workers=num_workers,
+        iterator_train__pin_memory=pin_memory,
+    )
+
+    reset_peak_memory()
+    start = time.perf_counter()
+    for i, data in enumerate(net.get_iterator(subset, training=True)):
+        if i == warmup:
+            if num_gpus() > 0:
+                torch.cuda.synchronize()
+            start = time.perf_counter()
+        net.train_step(*unpack_data(data))
+    if num_gpus() > 0:
+        torch.cuda.synchronize()
+    seconds = time.perf_counter() - start
+
+    return {
+        "images_per_second": (n_images - warmup * batch_size) / seconds,
+        "peak_memory": peak_memory(),
+    }
+
+
+def autotune_loader(
+    config: Dict[str, Any],
+    batch_sizes: Sequence[int] = (64, 128, 256, 512, 1024),
+    workers: Sequence[int] = (0, 2, 4),
+    memory_limit: int = None,
+    torchscript: bool = False,
+) -> Dict[str, Any]:
+    """
+    Find the loader settings with the highest training throughput for `config`.
+
+    If `torchscript` is True, the model is compiled with TorchScript, as it will be
+    when it's trained.
+
+    Batch sizes are tried in increasing order (with no loader workers) until one
+    exceeds `memory_limit` bytes; then, for the fastest batch size, the number of
+    workers (and, on GPU, whether to use pinned memory) are tuned. Each setting is
+    timed on a few batches (see `time_batches`), with the same trainer.
+
+    Returns a dictionary with keys batch_size, num_workers, pin_memory and
+    images_per_second.
+    """
+    results = []
+    trainer = timing_trainer(config, torchscript)
+
+    def run(batch_size, num_workers, pin_memory):
+        try:
+            result = time_batches(trainer, batch_size, num_workers, pin_memory)
+        except RuntimeError as e:
+            # Most likely out of memory
+            print(f"  batch_size={batch_size} failed: {e}")
+            if num_gpus() > 0:
+                torch.cuda.empty_cache()
+            return None
+        print(
+            f"  batch_size={batch_size}, num_workers={num_workers}, "
+            f"pin_memory={pin_memory}: {result['images_per_second']:.0f} images/s"
+        )
+        if memory_limit is not None and result["peak_memory"] > memory_limit:
+            print(f"  batch_size={batch_size} exceeds the memory limit")
+            return None
+        settings = {
+            "batch_size": batch_size,
+            "num_workers": num_workers,
+            "pin_memory": pin_memory,
+            "images_per_second": result["images_per_second"],
+        }
+        results.append(settings)
+        return settings
+
+    print(f"Finding fastest loader settings for {cache_key(config, torchscript)}...")
+    for batch_size in sorted(batch_sizes):
+        if run(batch_size, 0, False) is None:
+            break
+
+    if not results:
+        raise RuntimeError("No batch size could be trained within the memory limit")
+
+    batch_size = max(results, key=lambda r: r["images_per_second"])["batch_size"]
+    pin_memories = (False, True) if num_gpus() > 0 else (False,)
+    for num_workers in workers:
+        for pin_memory in pin_memories:
+            if num_workers > 0 or pin_memory:
+                run(batch_size, num_workers, pin_memory)
+
+    best = max(results, key=lambda r: r["images_per_second"])
+    print(f"Fastest loader settings: {best}")
+    return best
+
+
+def loader_settings(
+    config: Dict[str, Any], memory_limit: int = None, torchscript: bool = False
+):
+    """
+    Return the fastest loader settings for `config`, from the cache if possible.
+
+    See `autotune_loader` for the returned dictionary.
+    """
+    key = f"{cache_key(config, torchscript)}|{memory_limit}"
+    cache_dir.mkdir(parents=True, exist_ok=True)
+    path = cache_dir / f"{hashlib.sha1(key.encode()).hexdigest()}.json"
+
+    if not path.exists():
+        # Lock so that parallel jobs don't tune the same settings at the same time
+        with open(f"{path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            if not path.exists():
+                settings = autotune_loader(
+                    config, memory_limit=memory_limit, torchscript=torchscript
+                )
+                path.write_text(json.dumps({"key": key, "settings": settings}))
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+    return json.loads(path.read_text())["settings"]
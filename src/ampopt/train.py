@@ -6,12 +6,23 @@ from uuid import uuid4
 
 from amptorch.trainer import AtomsTrainer
 from amptorch.dataset_lmdb import get_lmdb_dataset
+from optuna.exceptions import TrialPruned
 from optuna.integration.skorch import SkorchPruningCallback
 from optuna.trial import FixedTrial
 from torch import nn
 from sklearn.metrics import mean_absolute_error
 
-from ampopt.utils import absolute, num_gpus, read_data, ampopt_path
+from ampopt.callbacks import (CallbackList, DeadlineCallback,
+                              PlateauStoppingCallback, ResumeCallback,
+                              completed_epochs)
+from ampopt.predict import (measure_latency, predict_energies, stream_metrics,
+                            unscaled_energies)
+from ampopt.preprocess import (MANIFEST_SUFFIX, cached_lmdb, lmdb_data_size,
+                               lmdb_shards, read_lmdb_metadata, read_lmdb_records,
+                               sigmas_dict)
+from ampopt.scripting import script_mlps
+from ampopt.throughput import loader_settings
+from ampopt.utils import absolute, num_gpus, read_data, ampopt_path, tensor_type
 
 warnings.simplefilter("ignore")
 
@@ -29,7 +40,8 @@ def get_param_dict(params, trial, name, *args, **kwargs):
         params: dict str -> int|float mapping param name to value
         trial: optuna trial
         name: name of param
-        *args, **kwargs: arguments for trial.suggest_int or trial.suggest_float
+        *args, **kwargs: arguments for trial.suggest_int or trial.suggest_float, or
+            a list of choices for trial.suggest_categorical
 
     Returns:
         dictionary str -> int|float mapping `name` to its value.
@@ -42,14 +54,170 @@ def get_param_dict(params, trial, name, *args, **kwargs):
         except KeyError:
             low = args[0]
         param_type = type(low).__name__
+        if isinstance(low, list):
+            param_type = "categorical"
         method = getattr(trial, f"suggest_{param_type}")
         val = method(name, *args, **kwargs)
 
     return {name: val}
 
 
-def mk_objective(verbose, epochs, train_fname, valid_fname=None, **params):
+# Ratio of the memory used by loaded images to their size in the LMDB, to allow for
+# the overhead of the Python objects
+in_memory_overhead = 1.5
+
+
+def choose_cache(lmdb_path, memory_budget):
+    """
+    Return the amptorch cache mode with which `lmdb_path` fits in `memory_budget`.
+
+    Returns a tuple of the mode and the estimated memory (in bytes) the dataset
+    would take up if fully loaded:
+
+    - "full" (load the whole dataset) if it fits in `memory_budget` bytes
+    - "partial" (load one shard at a time) if the largest shard fits
+    - "no" (read each image from the LMDB when it's needed) otherwise
+    """
+    sizes = [int(size * in_memory_overhead) for size in lmdb_data_size(lmdb_path)]
+    if memory_budget is None or sum(sizes) <= memory_budget:
+        return "full", sum(sizes)
+    if len(sizes) > 1 and max(sizes) <= memory_budget:
+        return "partial", sum(sizes)
+    return "no", sum(sizes)
+
+
+default_params = {
+    "step_size": 20,
+    "batch_size": 256,
+}
+
+
+def searches_descriptor(train_fname) -> bool:
+    """Return True if the descriptor settings are searched over for `train_fname`."""
+    is_manifest = str(train_fname).endswith(MANIFEST_SUFFIX)
+    return Path(train_fname).suffix != ".lmdb" and not is_manifest
+
+
+def suggest_params(trial, params, search_descriptor=False):
     """
+    Return a dictionary of the values of all hyperparameters for `trial`.
+
+    Hyperparameters in `params` are fixed to the given value, and the rest are
+    suggested by `trial` (see `mk_objective`).
+    """
+    params = {**default_params, **params}
+    get = partial(get_param_dict, params, trial)
+
+    hparams = {
+        **get("num_layers", 6, 20),
+        **get("num_nodes", 10, 30),
+        **get("dropout_rate", 0.0, 0.2),
+        **get("lr", 1e-5, 1e-1, log=True),
+        **get("step_size"),
+        **get("gamma", 0.5, 1.0),
+        **get("batch_size"),
+    }
+
+    if search_descriptor:
+        hparams.update(
+            {
+                **get("n_gaussians", sorted(sigmas_dict())),
+                **get("n_mcsh", 2, 4),
+                # Discrete, so that trials share featurized LMDBs
+                **get("cutoff", 4.0, 8.0, step=0.5),
+            }
+        )
+
+    return hparams
+
+
+def training_lmdb(train_path, hparams, precision):
+    """
+    Return the LMDB to train on for `hparams`.
+
+    If `train_path` isn't an LMDB, this is a cached LMDB of it featurized with the
+    descriptor settings in `hparams`.
+    """
+    if not searches_descriptor(train_path):
+        return train_path
+    return cached_lmdb(
+        train_path,
+        n_gaussians=hparams["n_gaussians"],
+        n_mcsh=hparams["n_mcsh"],
+        cutoff=hparams["cutoff"],
+        precision=precision,
+    )
+
+
+def mk_config(hparams, lmdb_path, epochs, identifier, precision, verbose):
+    """Return the amptorch config to train a model with `hparams` on `lmdb_path`."""
+    return {
+        "model": {
+            "num_layers": hparams["num_layers"],
+            "num_nodes": hparams["num_nodes"],
+            "name": "singlenn",
+            "get_forces": False,
+            "dropout": 1,
+            "dropout_rate": hparams["dropout_rate"],
+            "initialization": "xavier",
+            "activation": nn.Tanh,
+        },
+        "optim": {
+            "gpus": gpus,
+            "lr": hparams["lr"],
+            "scheduler": {
+                "policy": "StepLR",
+                "params": {
+                    "step_size": hparams["step_size"],
+                    "gamma": hparams["gamma"],
+                },
+            },
+            "batch_size": hparams["batch_size"],
+            "loss": "mae",
+            "epochs": epochs,
+        },
+        "dataset": {
+            "lmdb_path": lmdb_shards(lmdb_path),
+            "cache": "full",
+        },
+        "cmd": {
+            "seed": 12,
+            "identifier": identifier,
+            "dtype": tensor_type(precision),
+            "verbose": verbose,
+        },
+    }
+
+
+def mk_objective(
+    verbose,
+    epochs,
+    train_fname,
+    valid_fname=None,
+    valid_lmdb=None,
+    stream=False,
+    chunk_size=1000,
+    predict_batch_size=256,
+    predictions_fname=None,
+    precision=None,
+    multi_objective=False,
+    latency_images=100,
+    deadline=None,
+    auto_batch_size=False,
+    memory_limit=None,
+    early_stopping_patience=None,
+    early_stopping_tol=0.0,
+    memory_budget=None,
+    torchscript=False,
+    keep_checkpoints=False,
+    **params,
+):
+    """
+    Return an objective which trains a model on `train_fname` for `epochs` epochs.
+
+    The objective returns the model's energy MAE on `valid_fname` (or `valid_lmdb`)
+    if given, and otherwise on a 10% validation split of the training data.
+
     **params can contain the following hyperparameters:
 
     - num_layers
@@ -58,104 +226,314 @@ def mk_objective(verbose, epochs, train_fname, valid_fname=None, **params):
     - lr
     - step_size
     - batch_size
+    - n_gaussians, n_mcsh, cutoff (only if `train_fname` isn't an LMDB)
 
     If any of num_layers, num_nodes, dropout_rate or lr are not specified, then they
     will be searched over.
 
     If any of step_size or batch_size are not specified, they will be filled with
     default values.
+
+    `train_fname` is usually a preprocessed LMDB (or the manifest of a sharded
+    one). If it is a raw structure file instead, the GMP descriptor settings
+    (n_gaussians, n_mcsh, cutoff) are searched over too, and each configuration is
+    featurized once into a cached LMDB.
+
+    `precision` ("float32" or "float64") must match the precision the training LMDB
+    was preprocessed with. If None, the LMDB's precision is used.
+
+    If `valid_lmdb` is given instead of `valid_fname`, the model is scored on that
+    preprocessed LMDB, which must have been featurized with the same descriptor
+    settings as the training LMDB (e.g. by preprocessing both together).
+
+    If `stream` is True, the validation data is read, featurized and predicted
+    `chunk_size` images at a time (with `predict_batch_size` images per forward
+    pass) instead of all at once. Per-image predictions are written to
+    `predictions_fname` if given.
+
+    If `multi_objective` is True, the objective returns a tuple of (MAE, inference
+    latency per atom in seconds, number of model parameters). The latency is measured
+    on the first `latency_images` images of the training LMDB. Pruning isn't
+    supported for multi-objective studies, so no intermediate values are reported.
+
+    If `memory_budget` (in bytes) is given and the training dataset isn't expected
+    to fit in it, it is loaded one shard at a time, or read from disk as needed,
+    instead of all at once; see `choose_cache`. The choice is recorded in the
+    trial's `cache` user attribute.
+
+    If `auto_batch_size` is True and batch_size isn't given in `params`, the batch
+    size and data loader settings with the highest training throughput for each
+    model architecture are used (see `ampopt.throughput`), subject to `memory_limit`
+    (in bytes).
+
+    If `torchscript` is True, the model's MLPs are compiled with TorchScript (see
+    `ampopt.scripting`) for training and prediction, which reduces the per-layer
+    overhead of small models, particularly on CPU.
+
+    If `early_stopping_patience` is given, training stops once the validation MAE
+    (or, with `valid_fname` or `valid_lmdb`, the training MAE) hasn't improved by
+    more than a fraction `early_stopping_tol` for that many epochs. The model and
+    score of the best epoch are kept, and the number of epochs saved is recorded in
+    the trial's `epochs_saved` user attribute. This works with or without a pruner.
+
+    If `deadline` (a time as returned by `time.time()`) is given, training stops, and
+    the trial is pruned, once the next epoch isn't expected to finish before it.
+
+    The training state is saved to `checkpoint_dir(identifier)` after every epoch,
+    so that a failed trial can be resumed. The checkpoints are deleted once the trial
+    completes or is pruned, unless `keep_checkpoints` is True.
     """
     train_path = absolute(train_fname, root="cwd")
+    search_descriptor = searches_descriptor(train_path)
 
-    default_params = {
-        "step_size": 20,
-        "batch_size": 256,
-    }
-
-    for param, val in default_params.items():
-        params[param] = params.get(param, val)
+    if search_descriptor:
+        precision = precision or "float64"
+    else:
+        lmdb_precision = read_lmdb_metadata(train_path, "precision", default="float64")
+        if precision is None:
+            precision = lmdb_precision
+        elif precision != lmdb_precision:
+            raise ValueError(
+                f"Requested precision {precision} doesn't match the precision "
+                f"{lmdb_precision} that {train_path} was preprocessed with"
+            )
 
     if valid_fname is not None:
         valid_path = absolute(valid_fname, root="cwd")
+
+    if valid_lmdb is not None:
+        valid_lmdb = absolute(valid_lmdb, root="cwd")
+        if search_descriptor or read_lmdb_metadata(
+            valid_lmdb, "descriptor_setup"
+        ) != read_lmdb_metadata(train_path, "descriptor_setup"):
+            raise ValueError(
+                f"{valid_lmdb} wasn't featurized with the same descriptor settings "
+                f"as {train_path}"
+            )
+        valid_records = read_lmdb_records(
+            valid_lmdb, read_lmdb_metadata(valid_lmdb, "length")
+        )
+        y_valid = unscaled_energies(
+            valid_records, read_lmdb_metadata(valid_lmdb, "target_scaler")
+        )
+
+    if valid_fname is not None and not stream:
         if verbose:
             print("Loading validation data labels...")
         valid_data = read_data(valid_path)
         y_valid = [a.get_potential_energy() for a in valid_data]
 
+    # Without validation data, part of the training data is held out for validation
+    validation_split = valid_fname is None and valid_lmdb is None
+
     def objective(trial):
-        get = partial(get_param_dict, params, trial)
-        identifier = str(uuid4())
-        config = {
-            "model": {
-                **get("num_layers", 6, 20),
-                **get("num_nodes", 10, 30),
-                "name": "singlenn",
-                "get_forces": False,
-                "dropout": 1,
-                **get("dropout_rate", 0.0, 0.2),
-                "initialization": "xavier",
-                "activation": nn.Tanh,
-            },
-            "optim": {
-                "gpus": gpus,
-                **get("lr", 1e-5, 1e-1, log=True),
-                "scheduler": {
-                    "policy": "StepLR",
-                    "params": {
-                        **get("step_size"),
-                        **get("gamma", 0.5, 1.0),
-                    },
-                },
-                **get("batch_size"),
-                "loss": "mae",
-                "epochs": epochs,
-            },
-            "dataset": {
-                "lmdb_path": [train_path],
-                "cache": "full",
-            },
-            "cmd": {
-                "seed": 12,
-                "identifier": identifier,
-                "dtype": "torch.DoubleTensor",
-                "verbose": verbose,
-                "custom_callback": SkorchPruningCallback(trial, "train_energy_mae"),
-            },
-        }
+        hparams = suggest_params(trial, params, search_descriptor=search_descriptor)
+
+        # Trials retried after their worker died inherit the identifier of the
+        # failed trial, and resume training from its last checkpoint
+        identifier = trial.user_attrs.get("identifier", str(uuid4()))
+        trial.set_user_attr("identifier", identifier)
+        resume_dir = checkpoint_dir(identifier)
+        epochs_done = completed_epochs(resume_dir)
+
+        lmdb_path = training_lmdb(train_path, hparams, precision)
+        config = mk_config(
+            hparams,
+            lmdb_path,
+            epochs=epochs - epochs_done,
+            identifier=identifier,
+            precision=precision,
+            verbose=verbose,
+        )
 
-        if valid_fname is None:
+        callbacks = [ResumeCallback(resume_dir)]
+        plateau = None
+        if early_stopping_patience is not None:
+            plateau = PlateauStoppingCallback(
+                trial,
+                max_epochs=epochs,
+                patience=early_stopping_patience,
+                tolerance=early_stopping_tol,
+                monitor="val_energy_mae" if validation_split else "train_energy_mae",
+                checkpoint_dir=resume_dir,
+            )
+            callbacks.insert(0, plateau)
+        if not multi_objective:
+            callbacks.append(SkorchPruningCallback(trial, "train_energy_mae"))
+        if deadline is not None:
+            callbacks.append(DeadlineCallback(trial, deadline))
+        config["cmd"]["custom_callback"] = CallbackList(callbacks)
+
+        if validation_split:
             config["dataset"]["val_split"] = 0.1
 
+        if memory_budget is not None:
+            cache, footprint = choose_cache(lmdb_path, memory_budget)
+            config["dataset"]["cache"] = cache
+            trial.set_user_attr(
+                "cache",
+                {"mode": cache, "estimated_bytes": footprint, "budget": memory_budget},
+            )
+            if cache != "full":
+                print(
+                    f"Dataset needs ~{footprint / 2 ** 30:.2f}GB in memory, more "
+                    f"than the budget of {memory_budget / 2 ** 30:.2f}GB; "
+                    f"using cache={cache}"
+                )
+
+        loader = None
+        if auto_batch_size and "batch_size" not in params:
+            loader = loader_settings(
+                config, memory_limit=memory_limit, torchscript=torchscript
+            )
+            config["optim"]["batch_size"] = loader["batch_size"]
+            trial.set_user_attr("loader_settings", loader)
+
         trainer = AtomsTrainer(config)
-        trainer.train()
+        if torchscript:
+            n_scripted = script_mlps(trainer.net.module)
+            if verbose:
+                print(f"Compiled {n_scripted} submodules with TorchScript")
+        if loader is not None:
+            trainer.net.set_params(
+                iterator_train__num_workers=loader["num_workers"],
+                iterator_train__pin_memory=loader["pin_memory"],
+            )
+        try:
+            trainer.train()
+        except TrialPruned:
+            if not keep_checkpoints:
+                clean_up_checkpoints(identifier)
+            raise
 
-        if valid_fname is not None:
+        if valid_fname is not None and stream:
+            metrics = stream_metrics(
+                trainer,
+                valid_path,
+                chunk_size=chunk_size,
+                batch_size=predict_batch_size,
+                predictions_fname=predictions_fname,
+                verbose=verbose,
+            )
+            if verbose:
+                for name, val in metrics.items():
+                    print(f"  {name}: {val}")
+            score = metrics["energy_mae"]
+        elif valid_fname is not None:
             if verbose:
                 print("Calculating predictions on validation data...")
             y_pred = trainer.predict(valid_data, disable_tqdm=not verbose)["energy"]
 
+            score = mean_absolute_error(y_valid, y_pred)
+        elif valid_lmdb is not None:
+            y_pred = predict_energies(trainer, valid_records, predict_batch_size)
             score = mean_absolute_error(y_valid, y_pred)
         else:
-            score = trainer.net.history[-1, "val_energy_mae"]
+            scores = trainer.net.history[:, "val_energy_mae"]
+            score = scores[-1]
+            # Score the epoch whose parameters are kept
+            if plateau is not None and plateau.restored_:
+                score = scores[plateau.best_epoch(scores) - 1]
 
-        # clean_up_checkpoints(identifier)
+        values = score
+        if multi_objective:
+            latency = measure_latency(
+                trainer, read_lmdb_records(lmdb_path, latency_images)
+            )
+            n_params = sum(p.numel() for p in trainer.net.module.parameters())
+            if verbose:
+                print(f"Latency per atom: {latency:.3g}s, parameters: {n_params}")
+            values = score, latency, n_params
 
-        return score
+        # Only failed trials need their checkpoints, to be resumed
+        if not keep_checkpoints:
+            clean_up_checkpoints(identifier)
+        return values
 
     return objective
 
 
-def eval_score(epochs, train_fname, valid_fname=None, **params):
+def eval_score(
+    epochs,
+    train_fname,
+    valid_fname=None,
+    valid_lmdb=None,
+    stream=False,
+    chunk_size=1000,
+    predict_batch_size=256,
+    predictions_fname=None,
+    precision=None,
+    auto_batch_size=False,
+    early_stopping_patience=None,
+    early_stopping_tol=0.0,
+    torchscript=False,
+    **params,
+):
+    """
+    Train a single model and return its MAE on `valid_fname` (or the preprocessed
+    `valid_lmdb`).
+
+    For large validation files, pass `stream=True` to evaluate `chunk_size` images at a
+    time; see `mk_objective`.
+    """
+    if predictions_fname is not None:
+        predictions_fname = absolute(predictions_fname, root="cwd")
     objective = mk_objective(
         verbose=True,
         epochs=epochs,
         train_fname=train_fname,
         valid_fname=valid_fname,
+        valid_lmdb=valid_lmdb,
+        stream=stream,
+        chunk_size=chunk_size,
+        predict_batch_size=predict_batch_size,
+        predictions_fname=predictions_fname,
+        precision=precision,
+        auto_batch_size=auto_batch_size,
+        early_stopping_patience=early_stopping_patience,
+        early_stopping_tol=early_stopping_tol,
+        torchscript=torchscript,
         **params,
     )
     return objective(FixedTrial({}))
 
 
+def load_trainer(train_fname, checkpoint, precision=None, **params):
+    """
+    Return a trainer with the model saved in `checkpoint` by `ResumeCallback`.
+
+    `train_fname` and `params` must be those the model was trained with.
+    """
+    train_path = absolute(train_fname, root="cwd")
+    if precision is None:
+        precision = "float64"
+        if not searches_descriptor(train_path):
+            precision = read_lmdb_metadata(train_path, "precision", default=precision)
+    hparams = suggest_params(
+        FixedTrial(params), params, search_descriptor=searches_descriptor(train_path)
+    )
+    config = mk_config(
+        hparams,
+        training_lmdb(train_path, hparams, precision),
+        epochs=0,
+        identifier=f"load-{uuid4()}",
+        precision=precision,
+        verbose=False,
+    )
+    # Only the scalers and descriptor of the training data are needed
+    config["dataset"]["cache"] = "no"
+    trainer = AtomsTrainer(config)
+    trainer.net.initialize()
+    trainer.net.load_params(f_params=Path(checkpoint) / "params.pt")
+    return trainer
+
+
+def checkpoint_dir(identifier):
+    """Directory where the latest training state of trial `identifier` is saved."""
+    return Path("checkpoints") / identifier
+
+
 def clean_up_checkpoints(identifier):
+    """Delete the checkpoints of trial `identifier`, including amptorch's own."""
     for path in Path("checkpoints").glob(f"*{identifier}*"):
         rmtree(path)
@@ -1,11 +1,15 @@
 import os
 import subprocess
+import time
 from typing import Any, Dict
 
-from ampopt.study import get_or_create_study, get_study
+from ampopt.coordinator import coordinate
+from ampopt.study import (estimate_trial_duration, get_or_create_study, get_storage,
+                          get_study)
 from ampopt.train import mk_objective
 from ampopt.utils import (absolute, format_params, is_login_node, num_gpus,
-                          parse_params, read_params_from_env)
+                          parse_duration, parse_params, parse_size,
+                          read_params_from_env)
 
 
 def tune(
@@ -18,7 +22,42 @@ def tune(
     epochs: int = 100,
     params: str = "",
     verbose: bool = False,
+    precision: str = None,
+    multi_objective: bool = False,
+    time_budget: str = "",
+    coordinator: bool = False,
+    auto_batch_size: bool = False,
+    memory_limit: str = "",
+    early_stopping_patience: int = None,
+    early_stopping_tol: float = 0.0,
+    memory_budget: str = "",
+    torchscript: bool = False,
 ):
+    """
+    Run hyperparameter tuning.
+
+    If `jobs` > 1 and `coordinator` is True, this process owns the study and hands
+    trials out to the `jobs` worker processes (see `ampopt.coordinator`), instead of
+    each job running its own optimization.
+
+    If `auto_batch_size` is True (and batch_size isn't fixed in `params`), each model
+    architecture is trained with the batch size and data loader settings that give
+    the highest throughput within `memory_limit` (e.g. "2gb").
+
+    If `early_stopping_patience` is given, each trial stops once its MAE hasn't
+    improved by more than a fraction `early_stopping_tol` for that many epochs.
+
+    If `memory_budget` (e.g. "1.5gb") is given, datasets which aren't expected to
+    fit in it are loaded one shard at a time, or read from disk as needed, instead
+    of all at once.
+
+    If `torchscript` is True, the models are compiled with TorchScript.
+
+    `time_budget` is either a number of seconds or "HH:MM:SS". If given, new trials
+    are only started if they're expected to finish within the budget (based on the
+    durations of previous trials), and running trials are stopped just before it
+    runs out.
+    """
     if jobs < 1:
         print("Must be at least 1 job")
         print("Aborting")
@@ -40,11 +79,38 @@ def tune(
     print(f" - n_trials: {trials}")
     print(f" - sampler: {sampler}")
     print(f" - pruner: {pruner}")
+    if multi_objective:
+        print(" - objectives: MAE, latency per atom, num parameters")
     print(f" - num epochs: {epochs}")
+    if precision is not None:
+        print(f" - precision: {precision}")
+    time_budget = parse_duration(time_budget)
+    if time_budget is not None:
+        print(f" - time budget: {time_budget:.0f}s")
+    if auto_batch_size:
+        print(f" - batch size: fastest within memory limit {memory_limit or 'none'}")
+    memory_limit = parse_size(memory_limit)
+    if memory_budget:
+        print(f" - dataset memory budget: {memory_budget}")
+    memory_budget = parse_size(memory_budget)
+    if torchscript:
+        print(" - models compiled with TorchScript")
+    if early_stopping_patience is not None:
+        print(
+            f" - early stopping: after {early_stopping_patience} epochs with less "
+            f"than {early_stopping_tol:.1%} improvement"
+        )
 
     data = absolute(data, root="cwd")
     study_name = study
-    study = get_or_create_study(study_name=study_name, pruner=pruner, sampler=sampler)
+    storage = get_storage()
+    study = get_or_create_study(
+        study_name=study_name,
+        pruner=pruner,
+        sampler=sampler,
+        multi_objective=multi_objective,
+        storage=storage,
+    )
 
     if params == "env":
         print("Reading params from env")
@@ -65,6 +131,35 @@ def tune(
             params_dict=params_dict,
             verbose=verbose,
             study=study,
+            precision=precision,
+            multi_objective=multi_objective,
+            time_budget=time_budget,
+            auto_batch_size=auto_batch_size,
+            memory_limit=memory_limit,
+            early_stopping_patience=early_stopping_patience,
+            early_stopping_tol=early_stopping_tol,
+            memory_budget=memory_budget,
+            torchscript=torchscript,
+        )
+    elif coordinator:
+        coordinate(
+            study=study,
+            storage=storage,
+            n_trials=trials * jobs,
+            jobs=jobs,
+            data=data,
+            n_epochs=epochs,
+            params_dict=params_dict,
+            verbose=verbose,
+            precision=precision,
+            multi_objective=multi_objective,
+            time_budget=time_budget,
+            auto_batch_size=auto_batch_size,
+            memory_limit=memory_limit,
+            early_stopping_patience=early_stopping_patience,
+            early_stopping_tol=early_stopping_tol,
+            memory_budget=memory_budget,
+            torchscript=torchscript,
         )
     else:
         cmd = ["ampopt", "tune-local"]
@@ -77,6 +172,23 @@ def tune(
         cmd += ["--verbose" if verbose else "--no-verbose"]
         if params_dict:
             cmd += ["--params", format_params(**params_dict)]
+        if precision is not None:
+            cmd += ["--precision", precision]
+        if multi_objective:
+            cmd += ["--multi-objective"]
+        if time_budget is not None:
+            cmd += ["--time-budget", str(time_budget)]
+        if auto_batch_size:
+            cmd += ["--auto-batch-size"]
+        if memory_limit is not None:
+            cmd += ["--memory-limit", str(memory_limit)]
+        if early_stopping_patience is not None:
+            cmd += ["--early-stopping-patience", str(early_stopping_patience)]
+            cmd += ["--early-stopping-tol", str(early_stopping_tol)]
+        if memory_budget is not None:
+            cmd += ["--memory-budget", str(memory_budget)]
+        if torchscript:
+            cmd += ["--torchscript"]
 
         for i in range(jobs):
             subprocess.Popen(cmd, env={**os.environ, "CUDA_VISIBLE_DEVICES": str(i)})
@@ -89,10 +201,46 @@ def tune_local(
     params_dict: Dict[str, Any],
     verbose: bool,
     study,
+    precision: str = None,
+    multi_objective: bool = False,
+    time_budget: float = None,
+    auto_batch_size: bool = False,
+    memory_limit: int = None,
+    early_stopping_patience: int = None,
+    early_stopping_tol: float = 0.0,
+    memory_budget: int = None,
+    torchscript: bool = False,
 ):
+    deadline = None if time_budget is None else time.time() + time_budget
     objective = mk_objective(
-        verbose=verbose, epochs=n_epochs, train_fname=data, **params_dict
+        verbose=verbose,
+        epochs=n_epochs,
+        train_fname=data,
+        precision=precision,
+        multi_objective=multi_objective,
+        deadline=deadline,
+        auto_batch_size=auto_batch_size,
+        memory_limit=memory_limit,
+        early_stopping_patience=early_stopping_patience,
+        early_stopping_tol=early_stopping_tol,
+        memory_budget=memory_budget,
+        torchscript=torchscript,
+        **params_dict,
     )
     print(study.sampler)
     print(study.pruner)
-    study.optimize(objective, n_trials=n_trials)
+
+    if deadline is None:
+        study.optimize(objective, n_trials=n_trials)
+        return
+
+    for _ in range(n_trials):
+        estimate = estimate_trial_duration(study)
+        remaining = deadline - time.time()
+        if estimate is not None and estimate > remaining:
+            print(
+                f"Not starting another trial: expected to take {estimate:.0f}s, "
+                f"but only {remaining:.0f}s of the time budget remain"
+            )
+            return
+        study.optimize(objective, n_trials=1)
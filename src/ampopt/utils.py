@@ -10,12 +10,35 @@ import ase.io
 # Path to root of bdqm-hyperparam-tuning repo
 ampopt_path = Path(__file__).resolve().parents[2]
 
+# Supported floating point precisions, mapped to the torch tensor type amptorch uses
+tensor_types = {"float32": "torch.FloatTensor", "float64": "torch.DoubleTensor"}
+
+
+def tensor_type(precision: str) -> str:
+    """Return the name of the default tensor type to use for `precision`."""
+    try:
+        return tensor_types[precision]
+    except KeyError:
+        raise ValueError(
+            f"precision={precision} not allowed; must be one of {list(tensor_types)}"
+        )
+
+
 def read_data(fname):
     if fname.endswith(".traj"):
         return ase.io.Trajectory(fname)
     else:
         return ase.io.read(fname, ":")
 
+
+def iread_data(fname):
+    """Like `read_data`, but yield images one at a time instead of reading them all."""
+    if fname.endswith(".traj"):
+        return iter(ase.io.Trajectory(fname))
+    else:
+        return ase.io.iread(fname, ":")
+
+
 @lru_cache
 def num_gpus():
     return torch.cuda.device_count()
@@ -56,6 +79,36 @@ def parse_params(param_string, prefix="") -> Dict[str, Any]:
     return params
 
 
+def parse_duration(duration: str) -> float:
+    """
+    Parse a duration given either in seconds or as "HH:MM:SS" (like PBS walltimes).
+
+    Returns the number of seconds, or None if `duration` is empty.
+    """
+    if not duration:
+        return None
+    seconds = 0.0
+    for part in str(duration).split(":"):
+        seconds = seconds * 60 + float(part)
+    return seconds
+
+
+def parse_size(size: str) -> int:
+    """
+    Parse a memory size like "2gb" or "500mb" (like PBS mem requests) into bytes.
+
+    Returns None if `size` is empty.
+    """
+    if not size:
+        return None
+    size = str(size).strip().lower()
+    units = {"kb": 2 ** 10, "mb": 2 ** 20, "gb": 2 ** 30, "tb": 2 ** 40, "b": 1}
+    for unit, multiplier in units.items():
+        if size.endswith(unit):
+            return int(float(size[: -len(unit)]) * multiplier)
+    return int(float(size))
+
+
 def format_params(**params):
     return ",".join(f"{k}={v}" for k, v in sorted(params.items()))
 
@@ -16,6 +16,39 @@ def preprocess(
     data_dir: Optional[str] = typer.Option(
         None, help="directory to write LMDB files into"
     ),
+    precision: str = typer.Option(
+        "float64", help="precision to store features in (float32 or float64)"
+    ),
+    reduce: Optional[str] = typer.Option(
+        None, help="compress fingerprints with 'pca' or 'variance' feature selection"
+    ),
+    n_components: Optional[float] = typer.Option(
+        None,
+        help="PCA: number of components (>= 1) or fraction of variance to keep (< 1)",
+    ),
+    variance_threshold: float = typer.Option(
+        0.0, help="variance: drop features with variance at most this value"
+    ),
+    n_gaussians: int = typer.Option(
+        8, help="number of GMP Gaussians (one of the sets in data/GMP/sigmas.json)"
+    ),
+    n_mcsh: int = typer.Option(3, help="number of MCSH orders"),
+    cutoff: float = typer.Option(5, help="GMP cutoff radius"),
+    dedup: bool = typer.Option(False, help="remove duplicate images first"),
+    positions_tol: Optional[float] = typer.Option(
+        None, help="also remove images whose atoms all moved less than this"
+    ),
+    energy_tol: Optional[float] = typer.Option(
+        None, help="with --positions-tol, max energy difference of near-duplicates"
+    ),
+    codec: Optional[str] = typer.Option(
+        None, help="compress stored features with zlib, lzma, bz2, lz4 or zstd"
+    ),
+    shards: int = typer.Option(
+        1,
+        help="split each file into this many LMDBs (featurized in parallel for all "
+        "but the first file)",
+    ),
 ) -> None:
     """
     Scale, Precompute GMP features and save to LMDB.
@@ -30,7 +63,60 @@ def preprocess(
 
     from ampopt import preprocess
 
-    preprocess(train, *others, data_dir=data_dir)
+    preprocess(
+        train,
+        *others,
+        data_dir=data_dir,
+        precision=precision,
+        reduce=reduce,
+        n_components=n_components,
+        variance_threshold=variance_threshold,
+        n_gaussians=n_gaussians,
+        n_mcsh=n_mcsh,
+        cutoff=cutoff,
+        dedup=dedup,
+        positions_tol=positions_tol,
+        energy_tol=energy_tol,
+        codec=codec,
+        shards=shards,
+    )
+
+
+@app.command()
+def append_to_lmdb(
+    data: str = typer.Argument(..., help="file of new images to featurize"),
+    lmdb: str = typer.Argument(..., help="LMDB (or shard manifest) to append to"),
+    dedup: bool = typer.Option(False, help="remove duplicate images first"),
+    positions_tol: Optional[float] = typer.Option(
+        None, help="also remove images whose atoms all moved less than this"
+    ),
+    energy_tol: Optional[float] = typer.Option(
+        None, help="with --positions-tol, max energy difference of near-duplicates"
+    ),
+    check_drift: bool = typer.Option(
+        False, help="warn if the new data is out of range of the saved scalers"
+    ),
+    drift_tol: float = typer.Option(
+        0.05, help="fraction of out-of-range values which counts as drift"
+    ),
+) -> None:
+    """
+    Featurize new images and append them to an existing LMDB.
+
+    The images are featurized and scaled with the descriptor and scalers saved in
+    the LMDB, so existing images don't need to be featurized again.
+    """
+    from ampopt import append_to_lmdb
+
+    append_to_lmdb(
+        data,
+        lmdb,
+        dedup=dedup,
+        positions_tol=positions_tol,
+        energy_tol=energy_tol,
+        check_drift=check_drift,
+        drift_tol=drift_tol,
+    )
 
 
 # Tuning
@@ -43,7 +129,11 @@ def tune(
         ..., help="number of trials (num of models to train) per job"
     ),
     study: str = typer.Option(..., help="name of the study"),
-    data: str = typer.Option(..., help="Train dataset"),
+    data: str = typer.Option(
+        ...,
+        help="Train dataset (LMDB or shard manifest, or raw data to also tune the "
+        "descriptor)",
+    ),
     pruner: str = typer.Option("Hyperband", help="which pruning algorithm to use"),
     sampler: str = typer.Option("CmaEs", help="which sampling algorithm to use"),
     verbose: bool = typer.Option(
@@ -51,6 +141,36 @@ def tune(
     ),
     epochs: int = typer.Option(100, help="number of epochs for each trial"),
     params: str = typer.Option("", help="comma-separated list of key=value HP pairs"),
+    precision: Optional[str] = typer.Option(
+        None, help="float32 or float64; defaults to the precision of the LMDB"
+    ),
+    multi_objective: bool = typer.Option(
+        False, help="minimize MAE, inference latency and num parameters together"
+    ),
+    time_budget: str = typer.Option(
+        "", help="stop starting/running trials after this (seconds or HH:MM:SS)"
+    ),
+    coordinator: bool = typer.Option(
+        False, help="with jobs > 1, run the sampler in one process for all jobs"
+    ),
+    auto_batch_size: bool = typer.Option(
+        False, help="use the fastest batch size & loader settings for each model"
+    ),
+    memory_limit: str = typer.Option(
+        "", help="memory limit for --auto-batch-size, e.g. 2gb"
+    ),
+    early_stopping_patience: Optional[int] = typer.Option(
+        None, help="stop trials after this many epochs without improvement"
+    ),
+    early_stopping_tol: float = typer.Option(
+        0.0, help="minimum relative improvement for --early-stopping-patience"
+    ),
+    memory_budget: str = typer.Option(
+        "", help="memory to load the dataset into, e.g. 1.5gb (default: unlimited)"
+    ),
+    torchscript: bool = typer.Option(
+        False, help="compile the models with TorchScript (faster for small models)"
+    ),
 ):
     """
     Run HP tuning on this node.
@@ -87,6 +207,25 @@ def tune(
 
     - Grid uses a grid search (note: the code in study.py must be modified in
     to change the search space for Grid search)
+
+    ## Coordinator mode
+
+    With --coordinator and --jobs > 1, this process owns the study and its sampler,
+    and hands trials out to the jobs, which send their results back to it. This
+    avoids every job re-running the sampler and querying the DB separately.
+
+    ## Multi-objective tuning
+
+    With --multi-objective, each trial also measures the model's inference latency
+    per atom and its number of parameters, and the study finds the Pareto front of
+    all three objectives. Only the NSGAII, MOTPE and Random samplers can be used, and
+    trials aren't pruned.
+
+    ## Early stopping
+
+    With --early-stopping-patience=N, each trial stops once its MAE hasn't improved
+    (by more than --early-stopping-tol, relative) for N epochs, and keeps the score
+    of its best epoch. This works with any pruner, including None.
     """
     from ampopt import tune
 
@@ -100,6 +239,16 @@ def tune(
         verbose=verbose,
         epochs=epochs,
         params=params,
+        precision=precision,
+        multi_objective=multi_objective,
+        time_budget=time_budget,
+        coordinator=coordinator,
+        auto_batch_size=auto_batch_size,
+        memory_limit=memory_limit,
+        early_stopping_patience=early_stopping_patience,
+        early_stopping_tol=early_stopping_tol,
+        memory_budget=memory_budget,
+        torchscript=torchscript,
     )
 
 
@@ -112,6 +261,12 @@ def run_pace_tuning_job(
     sampler: str = typer.Option("CmaEs", help="which sampling algorithm to use"),
     epochs: int = typer.Option(100, help="number of epochs for each trial"),
     params: str = typer.Option("", help="comma-separated list of key=value HP pairs"),
+    time_budget: str = typer.Option(
+        "", help="time budget for the job's trials (seconds or HH:MM:SS)"
+    ),
+    memory_budget: str = typer.Option(
+        "1.5gb", help="memory to load the dataset into (the job requests 2gb)"
+    ),
 ):
     """
     Run hyperparameter tuning as a PACE job.
@@ -148,6 +303,8 @@ def run_pace_tuning_job(
         sampler=sampler,
         params=params,
         epochs=epochs,
+        time_budget=time_budget,
+        memory_budget=memory_budget,
     )
 
 
@@ -161,13 +318,27 @@ def tune_local(
     verbose: bool = typer.Option(...),
     sampler: str = typer.Option(...),
     pruner: str = typer.Option(...),
+    precision: Optional[str] = typer.Option(None),
+    multi_objective: bool = typer.Option(False),
+    time_budget: Optional[float] = typer.Option(None),
+    auto_batch_size: bool = typer.Option(False),
+    memory_limit: Optional[int] = typer.Option(None),
+    early_stopping_patience: Optional[int] = typer.Option(None),
+    early_stopping_tol: float = typer.Option(0.0),
+    memory_budget: Optional[int] = typer.Option(None),
+    torchscript: bool = typer.Option(False),
 ):
     """For internal use only."""
     from ampopt.tuning import tune_local
     from ampopt.utils import parse_params
     from ampopt.study import get_or_create_study
 
-    study = get_or_create_study(study_name=study_name, sampler=sampler, pruner=pruner)
+    study = get_or_create_study(
+        study_name=study_name,
+        sampler=sampler,
+        pruner=pruner,
+        multi_objective=multi_objective,
+    )
 
     tune_local(
         data=data,
@@ -176,6 +347,132 @@ def tune_local(
         params_dict=parse_params(params),
         verbose=verbose,
         study=study,
+        precision=precision,
+        multi_objective=multi_objective,
+        time_budget=time_budget,
+        auto_batch_size=auto_batch_size,
+        memory_limit=memory_limit,
+        early_stopping_patience=early_stopping_patience,
+        early_stopping_tol=early_stopping_tol,
+        memory_budget=memory_budget,
+        torchscript=torchscript,
+    )
+
+
+@app.command()
+def tune_worker(
+    address: str = typer.Option(...),
+    data: str = typer.Option(...),
+    epochs: int = typer.Option(...),
+    params: str = typer.Option(""),
+    verbose: bool = typer.Option(...),
+    precision: Optional[str] = typer.Option(None),
+    multi_objective: bool = typer.Option(False),
+    deadline: Optional[float] = typer.Option(None),
+    auto_batch_size: bool = typer.Option(False),
+    memory_limit: Optional[int] = typer.Option(None),
+    early_stopping_patience: Optional[int] = typer.Option(None),
+    early_stopping_tol: float = typer.Option(0.0),
+    memory_budget: Optional[int] = typer.Option(None),
+    torchscript: bool = typer.Option(False),
+):
+    """For internal use only."""
+    from ampopt.coordinator import work
+    from ampopt.utils import parse_params
+
+    work(
+        address=address,
+        data=data,
+        n_epochs=epochs,
+        params_dict=parse_params(params),
+        verbose=verbose,
+        precision=precision,
+        multi_objective=multi_objective,
+        deadline=deadline,
+        auto_batch_size=auto_batch_size,
+        memory_limit=memory_limit,
+        early_stopping_patience=early_stopping_patience,
+        early_stopping_tol=early_stopping_tol,
+        memory_budget=memory_budget,
+        torchscript=torchscript,
+    )
+
+
+# Finalization
+
+
+@app.command()
+def finalize(
+    study: str = typer.Option(..., help="name of the study"),
+    data: str = typer.Option(..., help="Train dataset the study was tuned on"),
+    holdout: str = typer.Option(
+        ..., help="holdout dataset (LMDB preprocessed with the train dataset)"
+    ),
+    top_k: int = typer.Option(3, help="number of best trials to retrain"),
+    epochs: int = typer.Option(1000, help="number of epochs to retrain for"),
+    jobs: int = typer.Option(1, help="number of trials to retrain in parallel"),
+    params: str = typer.Option(
+        "", help="comma-separated list of key=value HP pairs fixed during tuning"
+    ),
+    ensemble: bool = typer.Option(
+        False, help="also score the mean of the retrained models' predictions"
+    ),
+    precision: Optional[str] = typer.Option(
+        None, help="float32 or float64; defaults to the precision of the LMDB"
+    ),
+    verbose: bool = typer.Option(
+        False, help="Whether or not to log the per-epoch results"
+    ),
+):
+    """
+    Retrain the best trials of a study for longer and score them on a holdout set.
+
+    Trials are retrained in parallel, one per GPU (or, without GPUs, each on its own
+    share of the CPU cores). The holdout MAE, training time and checkpoint of each
+    model are saved to the study's `finalized` user attribute.
+    """
+    from ampopt import finalize
+
+    finalize(
+        study=study,
+        data=data,
+        holdout=holdout,
+        top_k=top_k,
+        epochs=epochs,
+        jobs=jobs,
+        params=params,
+        ensemble=ensemble,
+        precision=precision,
+        verbose=verbose,
+    )
+
+
+@app.command()
+def finalize_trial(
+    data: str = typer.Option(...),
+    holdout: str = typer.Option(...),
+    epochs: int = typer.Option(...),
+    number: int = typer.Option(...),
+    params: str = typer.Option(""),
+    output: str = typer.Option(...),
+    cores: str = typer.Option(""),
+    precision: Optional[str] = typer.Option(None),
+    verbose: bool = typer.Option(...),
+):
+    """For internal use only."""
+    from ampopt.finalize import retrain_trial
+    from ampopt.utils import parse_params
+
+    retrain_trial(
+        data=data,
+        holdout=holdout,
+        epochs=epochs,
+        number=number,
+        params=parse_params(params),
+        output=output,
+        cores=[int(c) for c in cores.split(",")] if cores else None,
+        precision=precision,
+        verbose=verbose,
     )
 
 